@@ -0,0 +1,157 @@
+"""Asyncio load generator for the server, reporting latency percentiles as JSON.
+
+Runs against any running server. To benchmark without tokens or network,
+start the server on the fake backend first:
+
+    POE_FAKE_BACKEND=1 uvicorn server:app --port 8000
+    python benchmark_server.py --requests 500 --concurrency 50 --stream
+
+Closed-loop mode (the default) keeps --concurrency requests in flight.
+Open-loop mode (--rate) starts requests on a fixed schedule, however slow
+the server gets, which shows queueing under overload.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 4)
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 4) if values else None,
+    }
+
+
+class Result:
+    def __init__(self, status, latency, ttft=None, error=None):
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+        self.error = error
+
+
+async def send_request(client, args, index):
+    prompt = args.prompt
+    if args.unique:
+        prompt = f"{prompt} #{index}-{random.random()}"
+    body = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": args.stream,
+    }
+    start = time.perf_counter()
+    try:
+        if not args.stream:
+            response = await client.post("/v1/chat/completions", json=body)
+            latency = time.perf_counter() - start
+            error = None
+            if response.status_code == 200:
+                # The server answers a failed upstream call with a 200 whose content is "fail".
+                choices = response.json().get("choices", [])
+                if any(choice["message"]["content"] == "fail" for choice in choices):
+                    error = "fail"
+            return Result(response.status_code, latency, error=error)
+
+        ttft = None
+        error = None
+        async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return Result(response.status_code, time.perf_counter() - start)
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if "error" in chunk:
+                    error = chunk["error"].get("type") or "error"
+                elif ttft is None and chunk["choices"][0]["delta"].get("content"):
+                    ttft = time.perf_counter() - start
+        return Result(response.status_code, time.perf_counter() - start, ttft, error)
+    except httpx.HTTPError as e:
+        return Result(None, time.perf_counter() - start, error=type(e).__name__)
+
+
+async def closed_loop(client, args):
+    results = []
+    counter = iter(range(args.requests))
+
+    async def worker():
+        for index in counter:
+            results.append(await send_request(client, args, index))
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return results
+
+
+async def open_loop(client, args):
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    tasks = []
+    for index in range(args.requests):
+        delay = start + index * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send_request(client, args, index)))
+    return await asyncio.gather(*tasks)
+
+
+def report(results, elapsed, args):
+    ok = [r for r in results if r.status == 200 and r.error is None]
+    statuses = {}
+    for r in results:
+        key = r.error if r.error is not None else str(r.status)
+        statuses[key] = statuses.get(key, 0) + 1
+    return {
+        "mode": "open" if args.rate else "closed",
+        "stream": args.stream,
+        "model": args.model,
+        "requests": len(results),
+        "concurrency": None if args.rate else args.concurrency,
+        "rate": args.rate,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(ok) / elapsed, 3) if elapsed else None,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else None,
+        "statuses": statuses,
+        "latency": summarize([r.latency for r in ok]),
+        "ttft": summarize([r.ttft for r in ok if r.ttft is not None]) if args.stream else None,
+    }
+
+
+async def main(args):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        start = time.perf_counter()
+        if args.rate:
+            results = await open_loop(client, args)
+        else:
+            results = await closed_loop(client, args)
+        elapsed = time.perf_counter() - start
+    print(json.dumps(report(results, elapsed, args), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="server base URL")
+    parser.add_argument("--requests", type=int, default=200, help="total requests to send")
+    parser.add_argument("--concurrency", type=int, default=20, help="requests in flight (closed loop)")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second (open loop)")
+    parser.add_argument("--stream", action="store_true", help="use SSE streaming and measure time to first token")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--prompt", default="Hello")
+    parser.add_argument("--unique", action="store_true", help="make every prompt unique to bypass the response cache")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(main(parser.parse_args()))
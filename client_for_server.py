@@ -1,24 +1,58 @@
+import html
+import json
+import os
 import sys
-import time
 import requests
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QTextEdit, QLineEdit, QPushButton, QLabel, QScrollBar
-from PyQt5.QtGui import QIcon, QColor, QPalette, QFont
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QCoreApplication
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QTextEdit, QLineEdit, QPushButton, QLabel
+from PyQt5.QtGui import QIcon, QFont, QTextCursor, QTextCharFormat
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 
+SERVER_URL = os.getenv("POE_SERVER_URL", "http://localhost:8000")  # Your server's address
+MODEL = os.getenv("POE_CLIENT_MODEL", "gpt-3.5-turbo")
 
-class TypingThread(QThread):
-    typing_done = pyqtSignal()
-    typing_output = pyqtSignal(str)
 
-    def __init__(self, response_text):
+class ResponseThread(QThread):
+    """Streams one reply from the server off the GUI thread.
+
+    Emits each piece of the reply as it arrives, then the whole reply, or
+    an error message if the request failed.
+    """
+    delta = pyqtSignal(str)
+    reply_done = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, session, messages):
         super().__init__()
-        self.response_text = response_text
+        self.session = session
+        self.messages = messages
 
     def run(self):
-        for char in self.response_text:
-            QThread.msleep(50)  # Simulate typing speed
-            self.typing_output.emit(char)
-        self.typing_done.emit()
+        parts = []
+        try:
+            with self.session.post(
+                f"{SERVER_URL}/v1/chat/completions",
+                json={"model": MODEL, "messages": self.messages, "stream": True},
+                stream=True,
+                timeout=(10, 300),
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue  # blank separators and keep-alive comments
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise RuntimeError(chunk["error"]["message"])
+                    text = chunk["choices"][0]["delta"].get("content")
+                    if text:
+                        parts.append(text)
+                        self.delta.emit(text)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.reply_done.emit("".join(parts))
 
 
 class LoadingLabel(QLabel):
@@ -38,8 +72,10 @@ class ChatClient(QWidget):
     def __init__(self):
         super().__init__()
         self.init_ui()
+        self.session = requests.Session()  # keeps the connection to the server open between messages
         self.messages = [{'role': 'system', 'content': 'You are a helpful assistant.'}]
-        self.typing_thread = None
+        self.response_thread = None
+        self.append_message('system', self.messages[0]['content'])
 
     def init_ui(self):
         self.setWindowTitle('ChatterBox')
@@ -48,6 +84,7 @@ class ChatClient(QWidget):
 
         # Create widgets
         self.message_view = QTextEdit()
+        self.message_view.setReadOnly(True)
         self.user_input = QLineEdit()
         self.send_button = QPushButton("Send")
         self.loading_label = LoadingLabel()
@@ -59,6 +96,7 @@ class ChatClient(QWidget):
         self.send_button.setStyleSheet("QPushButton { color: white; background-color: #555555; padding: 5px; }")
 
         self.send_button.clicked.connect(self.send_message)
+        self.user_input.returnPressed.connect(self.send_message)
 
         # Set up layout
         layout = QVBoxLayout()
@@ -73,60 +111,64 @@ class ChatClient(QWidget):
         user_message = self.user_input.text()
         if user_message.lower() == "exit":
             sys.exit()
-        self.loading_screen()
+        if not user_message.strip() or self.response_thread is not None:
+            return
+        self.user_input.clear()
         self.messages.append({'role': 'user', 'content': user_message})
-        self.update_message_view()
-
+        self.append_message('user', user_message)
         self.show_response()
 
-    def loading_screen(self):
-        self.loading_label.show()
-
     def show_response(self):
+        self.send_button.setEnabled(False)
+        self.loading_label.show()
+        self.append_message('assistant', '')
+        self.response_thread = ResponseThread(self.session, list(self.messages))
+        self.response_thread.delta.connect(self.append_to_last_message)
+        self.response_thread.reply_done.connect(self.finish_response)
+        self.response_thread.failed.connect(self.show_error)
+        self.response_thread.finished.connect(self.response_finished)
+        self.response_thread.start()
+
+    def append_message(self, role, content):
+        """Add a new message block at the end of the view."""
+        if role == 'user':
+            prefix = "<b>You:</b> "
+        elif role == 'assistant':
+            prefix = "<b>Assistant:</b> "
+        else:
+            prefix = ""
+        text = html.escape(content)
+        if role == 'system':
+            text = f"<i>{text}</i>"
+        self.message_view.append(prefix + text)
+
+    def append_to_last_message(self, text):
+        """Append streamed text to the end of the document, without redrawing it."""
+        scrollbar = self.message_view.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = self.message_view.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text, QTextCharFormat())  # plain format, so the bold prefix does not carry over
         self.loading_label.hide()
-        response_text = self.generate_response(self.messages)
-        self.typing_thread = TypingThread(response_text)
-        self.typing_thread.typing_done.connect(self.update_message_view)
-        self.typing_thread.typing_output.connect(self.append_char_to_last_message)
-        self.typing_thread.start()
-
-    def generate_response(self, messages):
-        response = requests.post(
-            "http://localhost:8000/v1/chat/completions",  # Your server's address
-            json={"messages": messages}
-        )
-        response.raise_for_status()  # Raise an error if the request failed
-        data = response.json()
-        return data["choices"][0]["content"]
-
-    def append_char_to_last_message(self, char):
-        self.messages[-1]['content'] += char
-        self.update_message_view(scroll_to_bottom=True)
-
-    def update_message_view(self, scroll_to_bottom=False):
-        self.message_view.clear()
-
-        for message in self.messages:
-            role = message['role']
-            content = message['content']
-
-            if role == 'user':
-                content = f"<b>You:</b> {content}"
-                self.message_view.append(content)
-            elif role == 'assistant':
-                content = f"<b>Assistant:</b> {content}"
-                self.message_view.append(content)
-            elif role == 'system':
-                content = f"<i>{content}</i>"
-                self.message_view.append(content)
-
-        self.message_view.append("")  # Add a blank line for spacing
-
-        if scroll_to_bottom:
-            scrollbar = self.message_view.verticalScrollBar()
+        if at_bottom:
             scrollbar.setValue(scrollbar.maximum())
 
-        self.user_input.clear()
+    def finish_response(self, reply):
+        self.messages.append({'role': 'assistant', 'content': reply})
+
+    def show_error(self, message):
+        # The failed turn is left out of the history, so the next request does
+        # not carry a question without an answer; its text goes back to the input.
+        if self.messages[-1]['role'] == 'user':
+            failed = self.messages.pop()
+            if not self.user_input.text():
+                self.user_input.setText(failed['content'])
+        self.append_to_last_message(f"[error: {message}, not sent]")
+
+    def response_finished(self):
+        self.response_thread = None
+        self.loading_label.hide()
+        self.send_button.setEnabled(True)
         self.user_input.setFocus()
 
 
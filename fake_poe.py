@@ -0,0 +1,102 @@
+"""Stand-in for the poe-api module, for benchmarks and local testing.
+
+Start the server with POE_FAKE_BACKEND=1 to use it instead of the real
+poe.Client. Nothing here touches the network. Its behaviour is set with
+these environment variables:
+
+    FAKE_POE_CONNECT_DELAY  seconds a client takes to connect (default 0.2)
+    FAKE_POE_LATENCY        seconds until the first chunk (default 0.5)
+    FAKE_POE_CHUNK_DELAY    seconds between chunks (default 0.02)
+    FAKE_POE_CHUNKS         chunks per reply (default 40)
+    FAKE_POE_ERROR_RATE     fraction of sends that fail outright (default 0)
+    FAKE_POE_TIMEOUT_RATE   fraction of sends that time out (default 0)
+    FAKE_POE_QUOTA          messages per client and bot before the daily
+                            limit is hit, 0 for unlimited (default 0)
+"""
+import os
+import random
+import threading
+import time
+
+CONNECT_DELAY = float(os.getenv("FAKE_POE_CONNECT_DELAY", "0.2"))
+LATENCY = float(os.getenv("FAKE_POE_LATENCY", "0.5"))
+CHUNK_DELAY = float(os.getenv("FAKE_POE_CHUNK_DELAY", "0.02"))
+CHUNKS = int(os.getenv("FAKE_POE_CHUNKS", "40"))
+ERROR_RATE = float(os.getenv("FAKE_POE_ERROR_RATE", "0"))
+TIMEOUT_RATE = float(os.getenv("FAKE_POE_TIMEOUT_RATE", "0"))
+QUOTA = int(os.getenv("FAKE_POE_QUOTA", "0"))
+
+CODENAMES = [
+    "capybara",
+    "a2",
+    "a2_2",
+    "a2_100k",
+    "chinchilla",
+    "agouti",
+    "beaver",
+    "vizcacha",
+    "acouchy",
+    "llama_2_70b_chat",
+]
+
+headers = {}
+
+
+class Client:
+    def __init__(self, token, proxy=None, headers=headers, **kwargs):
+        time.sleep(CONNECT_DELAY)
+        self.token = token
+        self.proxy = proxy
+        self.ws_connected = True
+        self._lock = threading.Lock()
+        self._remaining = {codename: QUOTA for codename in CODENAMES}
+        self.get_bots()
+
+    def _bot(self, codename):
+        return {
+            "chatId": hash((self.token, codename)) & 0xFFFFFF,
+            "defaultBotObject": {
+                "nickname": codename,
+                "displayName": codename,
+                "messageLimit": {
+                    "numMessagesRemaining": self._remaining[codename] if QUOTA else None
+                },
+            },
+        }
+
+    def get_bots(self, download_next_data=True):
+        self.bots = {codename: self._bot(codename) for codename in CODENAMES}
+        self.bot_names = {codename: codename for codename in CODENAMES}
+        return self.bots
+
+    def get_bot_by_codename(self, bot_codename):
+        return self.bots[bot_codename]
+
+    def get_remaining_messages(self, chatbot):
+        return self.get_bot_by_codename(chatbot)["defaultBotObject"]["messageLimit"]["numMessagesRemaining"]
+
+    def disconnect_ws(self):
+        self.ws_connected = False
+
+    def send_message(self, chatbot, message, with_chat_break=False, timeout=20, async_recv=True, suggest_callback=None):
+        with self._lock:
+            if QUOTA:
+                if self._remaining[chatbot] <= 0:
+                    raise RuntimeError(f"Daily limit reached for {chatbot}.")
+                self._remaining[chatbot] -= 1
+
+        roll = random.random()
+        if roll < ERROR_RATE:
+            raise RuntimeError("An unknown error occurred. Raw response data: {}")
+        if roll < ERROR_RATE + TIMEOUT_RATE:
+            time.sleep(min(timeout, LATENCY * 4))
+            raise RuntimeError("Response timed out.")
+
+        time.sleep(LATENCY)
+        words = f"{chatbot} reply to: {message}".split()
+        text = ""
+        for i in range(CHUNKS):
+            new = words[i % len(words)] + " "
+            text += new
+            yield {"text": text, "text_new": new, "state": "incomplete", "messageId": 1}
+            time.sleep(CHUNK_DELAY)
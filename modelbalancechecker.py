@@ -1,7 +1,29 @@
-import poe
+"""Scan the remaining Poe messages of every token and save them as a snapshot.
+
+Each token is connected once and all model codenames are read from that
+one connection. Tokens are scanned concurrently, and the snapshot is
+rewritten as results come in (at most once a second), so an interrupted
+scan loses almost nothing. A token scanned less than --max-age seconds
+ago is skipped, which makes repeated runs incremental. The server serves
+the snapshot at /v1/quota.
+
+    python modelbalancechecker.py --concurrency 8 --max-age 3600
+"""
+import argparse
 import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+
 from tqdm import tqdm
 
+if os.getenv("POE_FAKE_BACKEND"):
+    import fake_poe as poe  # local stand-in for benchmarks, see fake_poe.py
+else:
+    import poe
+
 # MODEL_MAPPING as per your provided list
 MODEL_MAPPING = {
     "assistant": "capybara",
@@ -18,31 +40,123 @@ MODEL_MAPPING = {
     "chat-bison-001": "acouchy",
     "llama-2-70b": "llama_2_70b_chat",
 }
+CODENAMES = sorted(set(MODEL_MAPPING.values()))
+
 
 def load_from_file(file_path: str) -> list:
+    if not os.path.exists(file_path):
+        return []
     with open(file_path, "r") as file:
         items = [item.strip() for item in file.readlines() if item.strip()]
     return items
 
-# Load the POE_TOKENS from a file called "tokens.txt"
-POE_TOKENS_FILE = "tokens.txt"
-POE_TOKENS = load_from_file(POE_TOKENS_FILE)
 
-# Load the PROXIES from a file called "proxies.txt"
-PROXY_LIST_FILE = "proxies.txt"
-PROXIES = load_from_file(PROXY_LIST_FILE)
+def token_id(token: str) -> str:
+    """Same short label the server uses, so the snapshot holds no secrets."""
+    return hashlib.sha256(token.encode()).hexdigest()[:10]
 
-current_proxy_index = 0
 
-def check_remaining_messages(token, proxy, model):
+def load_snapshot(path: str) -> dict:
+    try:
+        with open(path, "r") as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError):
+        return {"generated_at": None, "tokens": {}}
+    snapshot.setdefault("tokens", {})
+    return snapshot
+
+
+def save_snapshot(path: str, snapshot: dict):
+    """Write the snapshot atomically, so readers never see half a file."""
+    snapshot["generated_at"] = time.time()
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(snapshot, file, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def check_remaining_messages(token: str, proxy: str) -> dict:
+    """Connect once and read the remaining messages for every codename."""
     client = poe.Client(token=token, proxy=proxy)
-    remaining_messages = client.get_remaining_messages(model)
-    return remaining_messages if remaining_messages is not None else 0
-
-for model in MODEL_MAPPING.values():
-    total_remaining_messages = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {executor.submit(check_remaining_messages, token, PROXIES[i % len(PROXIES)], model): token for i, token in enumerate(POE_TOKENS)}
-        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=f"Processing {model}"):
-            total_remaining_messages += future.result()
-    print(f"Model: {model}, Total Remaining Messages: {total_remaining_messages}")
+    try:
+        return {
+            codename: client.get_remaining_messages(codename)
+            for codename in CODENAMES
+            if codename in client.bots
+        }
+    finally:
+        client.disconnect_ws()
+
+
+def scan(tokens: list, proxies: list, path: str, concurrency: int, max_age: float) -> dict:
+    snapshot = load_snapshot(path)
+    entries = snapshot["tokens"]
+    now = time.time()
+    due = [
+        (i, token)
+        for i, token in enumerate(tokens)
+        if now - entries.get(token_id(token), {}).get("scanned_at", 0) >= max_age
+    ]
+    print(f"Scanning {len(due)} of {len(tokens)} tokens ({len(tokens) - len(due)} are fresh).")
+
+    lock = threading.Lock()
+    last_save = [0.0]
+
+    def _scan_one(index: int, token: str):
+        proxy = proxies[index % len(proxies)] if proxies else None
+        entry = {"remaining": {}, "error": None}
+        try:
+            entry["remaining"] = check_remaining_messages(token, proxy)
+            entry["scanned_at"] = time.time()
+        except Exception as e:
+            entry["error"] = str(e)
+            previous = entries.get(token_id(token))
+            if previous:
+                # Keep the last known counts with the time they were read, so
+                # they are not taken for fresh ones.
+                entry["remaining"] = previous.get("remaining", {})
+                if "scanned_at" in previous:
+                    entry["scanned_at"] = previous["scanned_at"]
+        with lock:
+            entries[token_id(token)] = entry
+            if time.monotonic() - last_save[0] >= 1:
+                save_snapshot(path, snapshot)
+                last_save[0] = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(_scan_one, index, token) for index, token in due]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Scanning tokens"):
+            future.result()
+
+    save_snapshot(path, snapshot)
+    return snapshot
+
+
+def summarize(snapshot: dict, tokens: list) -> dict:
+    totals = {codename: 0 for codename in CODENAMES}
+    for token in tokens:
+        entry = snapshot["tokens"].get(token_id(token))
+        if entry is None:
+            continue
+        for codename, remaining in entry.get("remaining", {}).items():
+            if remaining is not None and codename in totals:
+                totals[codename] += max(remaining, 0)
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", default="tokens.txt", help="file with one token per line")
+    parser.add_argument("--proxies", default="proxies.txt", help="file with one proxy per line")
+    parser.add_argument("--output", default="quota_snapshot.json", help="snapshot file to update")
+    parser.add_argument("--concurrency", type=int, default=8, help="tokens scanned at once")
+    parser.add_argument("--max-age", type=float, default=0, help="skip tokens scanned less than this many seconds ago")
+    args = parser.parse_args()
+
+    tokens = load_from_file(args.tokens)
+    snapshot = scan(tokens, load_from_file(args.proxies), args.output, max(1, args.concurrency), args.max_age)
+    failed = sum(1 for token in tokens if (snapshot["tokens"].get(token_id(token)) or {}).get("error"))
+    for codename, total in summarize(snapshot, tokens).items():
+        print(f"Model: {codename}, Total Remaining Messages: {total}")
+    if failed:
+        print(f"{failed} tokens could not be checked; see {args.output}.")
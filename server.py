@@ -1,32 +1,94 @@
 from fastapi import FastAPI, Request, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response, JSONResponse
 from pydantic import BaseModel
 import asyncio
 import uvicorn
 import logging
-from typing import List, Optional
+import logging.handlers
+from typing import List, Optional, Union
 import time
 import os
 import json
 import random
 import string
-import sys
+import functools
+import hashlib
+import hmac
+import contextlib
+import math
+import bisect
+import heapq
+import sqlite3
 import signal
-
+import queue
+import uuid
+import contextvars
+import fcntl
+import tempfile
+from urllib.parse import urlsplit
+from collections import OrderedDict, deque
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 try:
-    import poe
+    import orjson  # optional, speeds up SSE encoding
 except ImportError:
-    import subprocess
-    import sys
+    orjson = None
 
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "poe-api"])
+if os.getenv("POE_FAKE_BACKEND"):
+    import fake_poe as poe  # local stand-in for benchmarks, see fake_poe.py
+else:
     import poe
 
-# Set up logging
-logging.basicConfig(filename="app.log", level=logging.INFO)
+# Set up logging. Handlers only put records on a queue; a background
+# thread formats them as JSON lines and writes them to the log file, so
+# the event loop never waits on disk.
+LOG_FILE = os.getenv("POE_LOG_FILE", "app.log")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the request ID and any trace attached."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            entry["request_id"] = request_id
+        trace = getattr(record, "trace", None)
+        if trace is not None:
+            entry.update(trace)
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """Tags records with the ID of the request being handled, if any.
+
+    Runs before the record is queued, while the request's context is
+    still current.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = current_trace.get()
+        record.request_id = trace.id if trace is not None else None
+        return True
+
+
+_log_queue = queue.SimpleQueue()
+_log_file_handler = logging.FileHandler(LOG_FILE)
+_log_file_handler.setFormatter(JsonFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_file_handler)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.addFilter(RequestIdFilter())
+logging.getLogger().addHandler(_queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+_log_listener.start()
 
 app = FastAPI()
 
@@ -62,6 +124,27 @@ MODEL_MAPPING = {
 
 IGNORED_MODELS = ["assistant", "claude-instant", "gpt-3.5-turbo-0613", "gpt-3.5-turbo", "chat-bison-001", "llama-2-70b"]
 
+# Context window of each bot, in tokens.
+CONTEXT_LIMITS = {
+    "capybara": 4096,
+    "a2": 9000,
+    "a2_2": 100000,
+    "a2_100k": 100000,
+    "chinchilla": 4096,
+    "agouti": 16384,
+    "beaver": 8192,
+    "vizcacha": 32768,
+    "acouchy": 4096,
+    "llama_2_70b_chat": 4096,
+}
+
+# Larger-context bot to use when a prompt does not fit the requested one.
+CONTEXT_UPGRADES = {
+    "chinchilla": "agouti",
+    "beaver": "vizcacha",
+    "a2": "a2_100k",
+}
+
 class Message(BaseModel):
     role: str
     content: str
@@ -72,14 +155,17 @@ class Messages(BaseModel):
     model: str
     messages: List[Message]
     stream: Optional[bool] = False  # By default, it's set to False
+    cache: Optional[bool] = True  # Set to False to skip the response cache
 
 
 class CompletionPayload(BaseModel):
-    prompt: str
-    max_tokens: int
-    temperature: float
-    presence_penalty: int
-    top_p: int
+    prompt: Union[str, List[str]]
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    top_p: Optional[float] = None
+    n: int = 1
+    stream: Optional[bool] = False
 
 
 class PoeResponse(BaseModel):
@@ -96,117 +182,2529 @@ poe.headers = {
 }
 
 
-class PoeProvider:
-    def __init__(
-        self,
-        POE_TOKENS: list = None,
-        PROXIES: list = None,
-        AI_MODEL: str = "chinchilla",
-        **kwargs,
+# Upstream execution settings. poe.Client is fully synchronous, so every call
+# into it runs on a dedicated thread pool instead of the event loop.
+UPSTREAM_WORKERS = int(os.getenv("POE_UPSTREAM_WORKERS", "64"))
+# poe.Client.send_message only lets one message be pending per client, so
+# extra concurrency on a single client just queues inside the library.
+CLIENT_CONCURRENCY = int(os.getenv("POE_CLIENT_CONCURRENCY", "1"))
+DISCONNECT_POLL_INTERVAL = 0.5
+
+
+class UpstreamExecutor:
+    """Runs blocking poe.Client calls on a bounded thread pool.
+
+    Each client gets its own semaphore so a slow account cannot take over
+    the whole pool. Calls are awaitable, and cancelling the awaiting task
+    sets a cancel event that the worker thread checks between chunks.
+    """
+
+    def __init__(self, max_workers: int = UPSTREAM_WORKERS, per_client: int = CLIENT_CONCURRENCY):
+        self.max_workers = max_workers
+        self.per_client = per_client
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="poe-upstream"
+        )
+        self._client_limits = {}
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.cancelled = 0
+
+    def _limit_for(self, client) -> asyncio.Semaphore:
+        key = id(client)
+        if key not in self._client_limits:
+            self._client_limits[key] = asyncio.Semaphore(self.per_client)
+        return self._client_limits[key]
+
+    def forget(self, client):
+        self._client_limits.pop(id(client), None)
+
+    async def _acquire(self, client) -> asyncio.Semaphore:
+        limit = self._limit_for(client)
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await limit.acquire()
+        finally:
+            self.waiting -= 1
+            trace_phase("acquire", time.monotonic() - start)
+        return limit
+
+    def _submit(self, limit: asyncio.Semaphore, fn, on_release=None):
+        """Submit ``fn`` and release ``limit`` once the thread has returned.
+
+        The per-client slot stays held until the worker thread is actually
+        done, even if the caller was cancelled, so a client never has more
+        calls running than its limit. ``on_release`` is then called on the
+        event loop.
+        """
+        loop = asyncio.get_running_loop()
+        self.active += 1
+
+        def _release():
+            self.active -= 1
+            self.completed += 1
+            limit.release()
+            if on_release is not None:
+                on_release()
+
+        try:
+            cf = self._pool.submit(fn)
+        except BaseException:
+            self.active -= 1
+            limit.release()
+            if on_release is not None:
+                on_release()
+            raise
+        cf.add_done_callback(lambda _: _call_soon_threadsafe(loop, _release))
+        return cf
+
+    async def run(self, client, fn, *args, **kwargs):
+        """Run ``fn(*args, cancel_event=..., **kwargs)`` on the pool."""
+        limit = await self._acquire(client)
+        cancel_event = threading.Event()
+        cf = self._submit(
+            limit, functools.partial(fn, *args, cancel_event=cancel_event, **kwargs)
+        )
+        try:
+            return await asyncio.wrap_future(cf)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            self.cancelled += 1
+            raise
+
+    async def stream(self, client, fn, *args, on_release=None, **kwargs):
+        """Iterate the blocking generator ``fn(*args, cancel_event=..., **kwargs)``.
+
+        Items are handed from the worker thread to the event loop through an
+        asyncio.Queue as they are produced. Closing or cancelling the async
+        iterator sets the cancel event so the thread stops reading.
+        ``on_release`` is called once the worker thread has returned, or
+        when the iterator is closed before the thread was started.
+        """
+        try:
+            limit = await self._acquire(client)
+        except BaseException:
+            if on_release is not None:
+                on_release()
+            raise
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        cancel_event = threading.Event()
+        end = object()
+
+        def _produce():
+            try:
+                for item in fn(*args, cancel_event=cancel_event, **kwargs):
+                    _call_soon_threadsafe(loop, items.put_nowait, (item, None))
+                    if cancel_event.is_set():
+                        break
+                _call_soon_threadsafe(loop, items.put_nowait, (end, None))
+            except BaseException as e:
+                _call_soon_threadsafe(loop, items.put_nowait, (end, e))
+
+        self._submit(limit, _produce, on_release)
+        finished = False
+        try:
+            while True:
+                item, error = await items.get()
+                if item is end:
+                    finished = True
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            if not finished:
+                cancel_event.set()
+                self.cancelled += 1
+
+    async def call(self, fn, *args):
+        """Run a blocking call on the pool that is not tied to a client."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.max_workers,
+            "per_client_limit": self.per_client,
+            "active": self.active,
+            "waiting_for_client": self.waiting,
+            "backlog": max(0, self.active - self.max_workers),
+            "saturation": round(min(self.active, self.max_workers) / self.max_workers, 3),
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _call_soon_threadsafe(loop, callback, *args):
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass  # the loop has already shut down
+
+
+def _stream_reply(
+    client, chatbot: str, message: str, with_chat_break: bool = True, cancel_event: threading.Event = None
+):
+    """Blocking generator: send a message and yield each new piece of the reply.
+
+    Runs on an UpstreamExecutor thread. Stops reading early if the request
+    that started it was cancelled.
+    """
+    for chunk in client.send_message(
+        chatbot=chatbot, message=message, async_recv=True, with_chat_break=with_chat_break
     ):
-        self.POE_TOKENS = POE_TOKENS or []
-        self.PROXIES = PROXIES or []
-        self.bad_tokens = []
-        self.AI_MODEL = AI_MODEL.lower()
-        self.current_token_index = 0
-        self.current_proxy_index = 0
-        self.current_client_index = 0
-
-        # Create a list of poe.Client instances
-        self.clients = [
-            poe.Client(token=token, proxy=proxy, headers=poe.headers)
-            for token, proxy in zip(self.POE_TOKENS, self.PROXIES)
+        if chunk["text_new"]:
+            yield chunk["text_new"]
+        if cancel_event is not None and cancel_event.is_set():
+            break
+
+
+async def cancel_on_disconnect(request: Request, awaitable):
+    """Await ``awaitable``, cancelling it if the HTTP client goes away."""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logging.info("Client disconnected, cancelling upstream call.")
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter. Only ever updated from the event loop thread, so
+    it needs no lock."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus text format."""
+
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield (
+                    f"{self.name}_bucket",
+                    _format_labels(self.labelnames + ("le",), labels + (le,)),
+                    cumulative,
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum", label_text, total
+            yield f"{self.name}_count", label_text, cumulative
+
+
+def proxy_label(proxy: Optional[str]) -> str:
+    """host:port of a proxy URL, without any credentials in it."""
+    if not proxy:
+        return "direct"
+    parts = urlsplit(proxy if "://" in proxy else f"//{proxy}")
+    host = parts.hostname or "unknown"
+    return f"{host}:{parts.port}" if parts.port else host
+
+
+class ServerMetrics:
+    """Prometheus metrics for the server.
+
+    Counters and histograms are updated where things happen; gauges are read
+    from the live provider state when /metrics is scraped, so the request
+    path pays nothing for them.
+    """
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "poe_request_duration_seconds", "Time to serve a completion request.", ("model", "stream")
+        )
+        self.time_to_first_token = Histogram(
+            "poe_time_to_first_token_seconds", "Time from request start to the first streamed piece.", ("model",)
+        )
+        self.requests = Counter("poe_requests_total", "Completion requests by outcome.", ("model", "outcome"))
+        self.upstream_duration = Histogram(
+            "poe_upstream_duration_seconds", "Duration of successful upstream calls.", ("client", "proxy")
+        )
+        self.upstream_first_chunk = Histogram(
+            "poe_upstream_first_chunk_seconds", "Time until an upstream call produced its first piece.", ("model",)
+        )
+        self.queue_wait = Histogram("poe_queue_wait_seconds", "Time requests spent in the admission queue.")
+        self.retries = Counter("poe_upstream_retries_total", "Upstream attempts that were retried.", ("model",))
+        self.retry_sleep = Counter(
+            "poe_upstream_retry_sleep_seconds_total", "Time spent sleeping between retries.", ("model",)
+        )
+        self.timeouts = Counter("poe_upstream_timeouts_total", "Upstream calls that timed out.", ("model", "client"))
+        self.reconnects = Counter("poe_client_reconnects_total", "Client reconnect attempts.", ("client", "outcome"))
+        self.hedges = Counter(
+            "poe_upstream_hedges_total", "Hedged upstream calls, by whether the hedge answered first.", ("model", "outcome")
+        )
+        self.errors = Counter(
+            "poe_upstream_errors_total", "Upstream errors by exception class.", ("model", "client", "exception")
+        )
+        self._collected = [
+            self.request_duration,
+            self.time_to_first_token,
+            self.requests,
+            self.upstream_duration,
+            self.upstream_first_chunk,
+            self.queue_wait,
+            self.retries,
+            self.retry_sleep,
+            self.timeouts,
+            self.errors,
+            self.reconnects,
+            self.hedges,
         ]
 
-    def check_remaining_messages(self):
-        for client in self.clients:
-            if self.AI_MODEL in IGNORED_MODELS:
-                logging.warning(f"Skipping remaining messages check for model {self.AI_MODEL}.")
-            return client
-        remaining_messages = client.get_remaining_messages(self.AI_MODEL)
-        if remaining_messages is not None and remaining_messages > 0:
-            return client
+    def _gauges(self, provider) -> list:
+        executor = provider.executor.stats()
+        admission = provider.admission.stats()
+        return [
+            ("poe_clients", "Connected clients.", [("", len(provider.pool))]),
+            ("poe_requests_running", "Admitted requests currently running.", [("", admission["running"])]),
+            ("poe_queue_depth", "Requests waiting for a free client.", [("", admission["queue_depth"])]),
+            ("poe_queue_wait_seconds_avg", "Moving average of the queue wait.", [("", admission["wait_avg"])]),
+            ("poe_executor_active", "Upstream calls on the thread pool.", [("", executor["active"])]),
+            ("poe_executor_saturation", "Fraction of upstream threads in use.", [("", executor["saturation"])]),
+            (
+                "poe_upstream_in_flight",
+                "Requests holding each client.",
+                [
+                    (_format_labels(("client", "proxy"), (slot.id, proxy_label(slot.proxy))), slot.in_flight)
+                    for slot in provider.pool.slots
+                ],
+            ),
+            (
+                "poe_client_circuit_open",
+                "1 while a client's circuit breaker keeps traffic away from it.",
+                [
+                    (
+                        _format_labels(("client", "proxy"), (slot.id, proxy_label(slot.proxy))),
+                        int(slot.breaker.state != "closed"),
+                    )
+                    for slot in provider.pool.slots
+                ],
+            ),
+        ]
+
+    def render(self, provider=None) -> str:
+        lines = []
+        for metric in self._collected:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        if provider is not None:
+            for name, help, samples in self._gauges(provider):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in samples:
+                    lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = ServerMetrics()
+
+
+# Request tracing. Every HTTP request gets an ID and a RequestTrace that
+# collects how long it spent in each phase. The phases go out in the
+# Server-Timing header and, for a sample of requests, as a JSON log record.
+TRACE_SAMPLE_RATE = float(os.getenv("POE_TRACE_SAMPLE_RATE", "1.0"))
+# Requests slower than this are always logged, whatever the sample rate.
+TRACE_SLOW_SECONDS = float(os.getenv("POE_TRACE_SLOW_SECONDS", "30"))
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+trace_logger = logging.getLogger("poe.trace")
+
+
+class RequestTrace:
+    """Phase timings of one request.
+
+    Phases that run more than once, like the upstream call on a retry, add
+    up. ``ttft`` and ``upstream`` both start before the client is acquired,
+    so they overlap with ``acquire``.
+    """
+
+    def __init__(self, method: str, path: str, request_id: str = None):
+        self.id = request_id or uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.started = time.monotonic()
+        self.phases = {}
+        self.attrs = {}
+        self.status = None
+        self.retries = 0
+        self.finished = False
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
+
+    def server_timing(self) -> str:
+        entries = [f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items()]
+        entries.append(f"total;dur={(time.monotonic() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def finish(self):
+        """Log the trace once the last byte of the response has been sent."""
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.monotonic() - self.started
+        sampled = random.random() < TRACE_SAMPLE_RATE
+        if not (sampled or duration >= TRACE_SLOW_SECONDS or (self.status or 500) >= 500):
+            return
+        trace_logger.info(
+            f"{self.method} {self.path} {self.status} in {duration:.3f}s",
+            extra={
+                "trace": {
+                    "method": self.method,
+                    "path": self.path,
+                    "status": self.status,
+                    "duration_ms": round(duration * 1000, 1),
+                    "phases_ms": {k: round(v * 1000, 1) for k, v in self.phases.items()},
+                    "retries": self.retries,
+                    **self.attrs,
+                }
+            },
+        )
+
+
+def trace_phase(phase: str, seconds: float):
+    """Add to a phase of the current request, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(phase, seconds)
+
+
+class TracingMiddleware:
+    """Gives every request a RequestTrace and reports it when done.
+
+    ``Server-Timing`` can only carry the phases finished before the
+    response headers go out; for a stream that is everything up to the
+    first piece. The log record written at the end has them all.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        trace = RequestTrace(scope["method"], scope["path"], request_id)
+        token = current_trace.set(trace)
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                headers.append((b"x-request-id", trace.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                trace.finish()
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            trace.finish()
+            current_trace.reset(token)
+
+
+app.add_middleware(TracingMiddleware)
+
+
+# Quota refresh settings. Remaining-message counts are read in the
+# background and kept in memory so routing never waits on them.
+QUOTA_REFRESH_INTERVAL = float(os.getenv("POE_QUOTA_REFRESH_INTERVAL", "300"))
+QUOTA_REFRESH_JITTER = 0.2
+QUOTA_ERROR_PREFIX = "Daily limit reached"
+# Snapshot written by modelbalancechecker.py. It covers tokens no worker has
+# connected yet; fresher counts from the running clients take precedence.
+QUOTA_SNAPSHOT_FILE = os.getenv("POE_QUOTA_SNAPSHOT", "quota_snapshot.json")
+
+# Client start-up settings. Clients connect in parallel and the server
+# starts serving once MIN_READY_CLIENTS of them are up.
+CONNECT_CONCURRENCY = int(os.getenv("POE_CONNECT_CONCURRENCY", "16"))
+MIN_READY_CLIENTS = int(os.getenv("POE_MIN_READY_CLIENTS", "1"))
+SLOW_CONNECT_SECONDS = 10.0
+
+# Response cache settings. The cache is off unless POE_CACHE_SIZE is set.
+CACHE_SIZE = int(os.getenv("POE_CACHE_SIZE", "0"))
+CACHE_TTL = float(os.getenv("POE_CACHE_TTL", "300"))
+
+# Admission control. Requests beyond what the healthy clients can run wait
+# in a bounded queue; when that is full they are turned away with a 429.
+QUEUE_PER_CLIENT = int(os.getenv("POE_QUEUE_PER_CLIENT", "4"))
+QUEUE_MAX_WAIT = float(os.getenv("POE_QUEUE_MAX_WAIT", "30"))
+
+# Conversation affinity: follow-up turns go back to the Poe chat that
+# already holds the earlier messages. POE_AFFINITY_SIZE=0 turns it off.
+AFFINITY_SIZE = int(os.getenv("POE_AFFINITY_SIZE", "1024"))
+AFFINITY_TTL = float(os.getenv("POE_AFFINITY_TTL", "1800"))
+
+# Rate limits per caller (API key, or IP address without one) and model,
+# as JSON: {"default": {"requests": 60, "messages": 120}, "gpt-4": {...}}
+# per RATE_LIMIT_PERIOD seconds. Empty means no limits.
+RATE_LIMITS = json.loads(os.getenv("POE_RATE_LIMITS", "{}") or "{}")
+RATE_LIMIT_PERIOD = float(os.getenv("POE_RATE_LIMIT_PERIOD", "60"))
+# How often workers exchange what each caller has spent.
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("POE_RATE_LIMIT_SYNC_INTERVAL", "2"))
+
+# Context check. Prompts are estimated before they are sent, leaving
+# CONTEXT_REPLY_RESERVE tokens for the reply. One that does not fit even the
+# larger sibling model is trimmed (oldest messages first) with
+# CONTEXT_OVERFLOW=trim, or rejected with a 400 with CONTEXT_OVERFLOW=reject.
+CONTEXT_REPLY_RESERVE = int(os.getenv("POE_CONTEXT_REPLY_RESERVE", "512"))
+CONTEXT_OVERFLOW = os.getenv("POE_CONTEXT_OVERFLOW", "reject")
+TOKEN_CACHE_SIZE = 4096
+
+# Most choices (prompts times n) one legacy completions request may ask for.
+COMPLETION_MAX_CHOICES = int(os.getenv("POE_COMPLETION_MAX_CHOICES", "32"))
+
+# Request hedging. A call that has not produced its first piece after the
+# model's recent HEDGE_QUANTILE time to first piece (but at least
+# HEDGE_MIN_DELAY seconds) is sent again on an idle client, and the first
+# to answer wins. HEDGE_BUDGET caps the extra calls as a fraction of all
+# calls; 0 turns hedging off.
+HEDGE_BUDGET = float(os.getenv("POE_HEDGE_BUDGET", "0"))
+HEDGE_QUANTILE = float(os.getenv("POE_HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("POE_HEDGE_MIN_DELAY", "1"))
+# First delay between retries; it doubles with each retry, up to 2s.
+RETRY_BASE_DELAY = float(os.getenv("POE_RETRY_BASE_DELAY", "0.25"))
+
+# Batch jobs. Each batch runs at most BATCH_CONCURRENCY items at a time
+# (callers may ask for up to BATCH_MAX_CONCURRENCY); finished batches are
+# kept for BATCH_TTL seconds so clients can resume reading them. An item
+# the server keeps turning away fails after BATCH_ITEM_MAX_WAIT seconds.
+BATCH_CONCURRENCY = int(os.getenv("POE_BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("POE_BATCH_MAX_CONCURRENCY", "64"))
+BATCH_TTL = float(os.getenv("POE_BATCH_TTL", "3600"))
+BATCH_ITEM_MAX_WAIT = float(os.getenv("POE_BATCH_ITEM_MAX_WAIT", "600"))
+
+# SSE output. Small pieces are merged until SSE_COALESCE_BYTES are buffered
+# or SSE_COALESCE_MS have passed; a comment is sent after SSE_KEEPALIVE
+# idle seconds. A stream starts without waiting for its first piece once
+# SSE_FIRST_PIECE_WAIT seconds have passed since it left the request queue
+# (errors before that, including queue rejections, become HTTP errors).
+SSE_COALESCE_BYTES = int(os.getenv("POE_SSE_COALESCE_BYTES", "64"))
+SSE_COALESCE_MS = float(os.getenv("POE_SSE_COALESCE_MS", "25"))
+SSE_KEEPALIVE = float(os.getenv("POE_SSE_KEEPALIVE", "15"))
+SSE_FIRST_PIECE_WAIT = float(os.getenv("POE_SSE_FIRST_PIECE_WAIT", "5"))
+
+TOKENS_FILE = "tokens.txt"
+PROXIES_FILE = "proxies.txt"
+# How often tokens.txt and proxies.txt are checked for changes.
+WATCH_INTERVAL = float(os.getenv("POE_WATCH_INTERVAL", "5"))
+# How long a retired client may keep serving requests already on it.
+RETIRE_TIMEOUT = 120.0
+# How long closing all clients at shutdown may take.
+CLIENT_CLOSE_TIMEOUT = 5.0
+
+# Coordination between uvicorn workers. With "sqlite", workers lease
+# tokens through a shared SQLite database so each token is used by exactly
+# one worker; "none" makes every worker use every token.
+WORKER_COORDINATION = os.getenv("POE_WORKER_COORDINATION", "sqlite")
+STATE_DB = os.getenv("POE_STATE_DB", "poe_state.db")
+LEASE_INTERVAL = float(os.getenv("POE_LEASE_INTERVAL", "10"))
+# Leases and worker registrations expire after this many missed renewals.
+LEASE_MISSES = 3
+# Wait after registering so workers starting together see each other.
+LEASE_STARTUP_GRACE = 1.0
+
+# Errors after which a client's websocket has to be rebuilt.
+CONNECTION_ERROR_PREFIXES = (
+    "Websocket closed",
+    "Connection to remote host was lost",
+    "Timed out waiting for websocket to connect",
+)
+
+def resolve_model(model: str) -> str:
+    """Map an OpenAI-style model name to the Poe bot codename."""
+    return MODEL_MAPPING.get(model, model)
+
+
+# Codenames that have a daily message limit worth tracking.
+LIMITED_CODENAMES = sorted(
+    {codename for model, codename in MODEL_MAPPING.items() if model not in IGNORED_MODELS}
+)
+
+
+def token_id(token: str) -> str:
+    """Short, non-secret label for a token, for logs and status output."""
+    return hashlib.sha256(token.encode()).hexdigest()[:10]
+
+
+def _connect_client(token: str, proxy: Optional[str]):
+    """Blocking: build a poe.Client, which performs the full handshake."""
+    return poe.Client(token=token, proxy=proxy, headers=poe.headers)
+
+
+class NoClientAvailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Keeps traffic away from a client that keeps failing.
+
+    ``closed`` lets everything through. After ``failure_threshold``
+    consecutive failures (or an explicit trip) it goes ``open`` for an
+    exponentially growing backoff, then ``half_open``, where a single probe
+    request decides whether it closes again or re-opens.
+    """
+
+    FAILURE_THRESHOLD = 3
+    BASE_BACKOFF = 5.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def allows(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() < self.open_until:
+                return False
+            self.state = "half_open"
+        return not self.probing
+
+    def on_lease(self):
+        if self.state == "half_open":
+            self.probing = True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.FAILURE_THRESHOLD:
+            self.trip()
+
+    def trip(self) -> float:
+        """Open the circuit and return how long it stays open."""
+        self.trips += 1
+        backoff = min(self.MAX_BACKOFF, self.BASE_BACKOFF * 2 ** (self.trips - 1))
+        backoff *= random.uniform(0.8, 1.2)
+        self.state = "open"
+        self.open_until = time.monotonic() + backoff
+        self.probing = False
+        return backoff
+
+
+class TokenQuarantine:
+    """Keeps failed tokens out of rotation until their backoff runs out.
+
+    Entries are keyed by ``(token_id, codename)``; a codename of None covers
+    every model of the token. Each records why the token failed, and the
+    backoff for that reason doubles with every failure in a row. Release
+    times sit in a min-heap, so the next release is always at the top, while
+    ``allows`` is two dict lookups. The state is plain data that can be
+    saved and loaded, see ``save_quarantine_to_file``.
+    """
+
+    # (first backoff, longest backoff) in seconds per reason. Poe resets
+    # daily limits once a day; a token that cannot connect is probably
+    # invalid; a timeout usually clears up quickly.
+    BACKOFF = {
+        "quota": (3600.0, 86400.0),
+        "auth": (600.0, 86400.0),
+        "timeout": (30.0, 600.0),
+    }
+
+    def __init__(self):
+        self.entries = {}  # (token_id, codename) -> {"reason", "until", "strikes"}
+        self.strikes = {}  # (token_id, codename) -> failures in a row
+        self.lifted = {}  # (token_id, codename) -> "until" of an entry released early
+        self._heap = []
+        self.changed = asyncio.Event()
+
+    def allows(self, token: str, codename: str = None) -> bool:
+        return (token, None) not in self.entries and (token, codename) not in self.entries
+
+    def blocks_connect(self, token: str) -> bool:
+        """Whether the token should not even be connected: it was rejected."""
+        entry = self.entries.get((token, None))
+        return entry is not None and entry["reason"] == "auth"
+
+    def add(self, token: str, reason: str, codename: str = None, until: float = None) -> float:
+        """Quarantine a token, or one model of it; return the backoff in seconds."""
+        key = (token, codename)
+        strikes = self.strikes.get(key, 0) + 1
+        self.strikes[key] = strikes
+        if until is None:
+            base, cap = self.BACKOFF[reason]
+            until = time.time() + min(cap, base * 2 ** (strikes - 1)) * random.uniform(0.9, 1.1)
+        self.entries[key] = {"reason": reason, "until": until, "strikes": strikes}
+        self.lifted.pop(key, None)
+        heapq.heappush(self._heap, (until, token, codename or ""))
+        self.changed.set()
+        return until - time.time()
+
+    def release(self, token: str, codename: str = None):
+        """Lift a quarantine early, e.g. once a quota refresh shows messages left."""
+        entry = self.entries.pop((token, codename), None)
+        if entry is not None:
+            self.lifted[(token, codename)] = entry["until"]  # so the saved copy is dropped too
+            self.changed.set()
+
+    def record_success(self, token: str, codename: str):
+        """Reset the backoff of a token that works again."""
+        self.strikes.pop((token, None), None)
+        self.strikes.pop((token, codename), None)
+
+    def release_due(self) -> list:
+        """Release every entry whose time has come; return their keys."""
+        now = time.time()
+        released = []
+        while self._heap and self._heap[0][0] <= now:
+            until, token, codename = heapq.heappop(self._heap)
+            key = (token, codename or None)
+            entry = self.entries.get(key)
+            if entry is not None and entry["until"] == until:  # skip superseded heap items
+                del self.entries[key]
+                released.append(key)
+        if released:
+            self.changed.set()
+        return released
+
+    def next_release(self) -> Optional[float]:
+        """Seconds until the next entry is due, None if there is none."""
+        while self._heap:
+            until, token, codename = self._heap[0]
+            entry = self.entries.get((token, codename or None))
+            if entry is not None and entry["until"] == until:
+                return max(0.0, until - time.time())
+            heapq.heappop(self._heap)
         return None
 
-    def _get_current_client(self):
-        return self.clients[self.current_client_index]
+    def rows(self) -> list:
+        return [
+            {"token": token, "codename": codename, **entry}
+            for (token, codename), entry in self.entries.items()
+        ]
+
+    def lifted_rows(self) -> list:
+        """Entries released early that have not run out yet, as saved rows would have them."""
+        now = time.time()
+        for key, until in list(self.lifted.items()):
+            if until <= now:
+                del self.lifted[key]
+        return [
+            {"token": token, "codename": codename, "until": until}
+            for (token, codename), until in self.lifted.items()
+        ]
+
+    def load(self, rows: list):
+        now = time.time()
+        for row in rows:
+            if row["until"] > now and row["reason"] in self.BACKOFF:
+                key = (row["token"], row.get("codename"))
+                self.strikes[key] = max(row.get("strikes", 1) - 1, 0)
+                self.add(row["token"], row["reason"], row.get("codename"), until=row["until"])
+
+    def stats(self) -> dict:
+        reasons = {}
+        for entry in self.entries.values():
+            reasons[entry["reason"]] = reasons.get(entry["reason"], 0) + 1
+        return {
+            "quarantined": len(self.entries),
+            "reasons": reasons,
+            "next_release": round(self.next_release(), 1) if self.entries else None,
+        }
+
 
-    def _rotate_client(self):
-        self.current_client_index = (self.current_client_index + 1) % len(self.clients)
+class ClientSlot:
+    """One Poe account: its token, the proxy it talks through and its client."""
+
+    # Latency assumed for a slot that has not completed a call yet, while no
+    # slot of the pool has (otherwise the pool's mean latency is used).
+    DEFAULT_LATENCY = 5.0
+    # Weight of the newest sample in the latency moving average.
+    LATENCY_ALPHA = 0.3
+
+    def __init__(self, token: str, proxy: Optional[str], client):
+        self.token = token
+        self.proxy = proxy
+        self.client = client
+        self.id = token_id(token)
+        self.in_flight = 0
+        self.latency = None
+        self.connect_time = None
+        self.breaker = CircuitBreaker()
+        self.reconnecting = False
+
+    def expected_wait(self, default_latency: float = DEFAULT_LATENCY) -> float:
+        """Rough time until a new request on this slot would finish."""
+        return (self.in_flight + 1) * (self.latency or default_latency)
+
+    def record_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_ALPHA * (seconds - self.latency)
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "in_flight": self.in_flight,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "connect_time": round(self.connect_time, 3) if self.connect_time is not None else None,
+            "circuit": self.breaker.state,
+            "reconnecting": self.reconnecting,
+        }
+
+
+def _read_quotas(client, codenames: List[str], cancel_event: threading.Event = None) -> dict:
+    """Blocking: re-download the bot list and read the remaining messages."""
+    client.get_bots(download_next_data=False)
+    return {
+        codename: client.get_remaining_messages(codename)
+        for codename in codenames
+        if codename in client.bots
+    }
+
+
+class QuotaTracker:
+    """Remaining-message counts per (client slot, codename), kept in memory.
+
+    Counts are refreshed on a jittered background schedule and decremented
+    locally after each send. A slot is marked exhausted as soon as Poe
+    reports the daily limit, so routing can skip it with one set lookup.
+    Codenames without a known limit are always treated as available.
+    """
 
-    def set_model(self, model: str):
-        if model in MODEL_MAPPING:
-            self.AI_MODEL = MODEL_MAPPING[model]
+    def __init__(
+        self,
+        executor: UpstreamExecutor,
+        codenames: List[str] = LIMITED_CODENAMES,
+        interval: float = QUOTA_REFRESH_INTERVAL,
+        jitter: float = QUOTA_REFRESH_JITTER,
+        quarantine: TokenQuarantine = None,
+    ):
+        self.executor = executor
+        self.quarantine = quarantine
+        self.codenames = list(codenames)
+        self.interval = interval
+        self.jitter = jitter
+        self.remaining = {}
+        self.exhausted = set()
+        self.refreshed_at = {}
+
+    def is_available(self, slot: ClientSlot, codename: str) -> bool:
+        return (slot.id, codename) not in self.exhausted
+
+    def update(self, slot: ClientSlot, codename: str, remaining: Optional[int]):
+        key = (slot.id, codename)
+        self.remaining[key] = remaining
+        if remaining is not None and remaining <= 0:
+            self.exhausted.add(key)
+        else:
+            self.exhausted.discard(key)
+            if remaining is not None and self.quarantine is not None:
+                self.quarantine.release(slot.id, codename)
+
+    def record_send(self, slot: ClientSlot, codename: str):
+        remaining = self.remaining.get((slot.id, codename))
+        if remaining is not None:
+            self.update(slot, codename, remaining - 1)
+
+    def mark_exhausted(self, slot: ClientSlot, codename: str):
+        self.update(slot, codename, 0)
+        if self.quarantine is not None:
+            backoff = self.quarantine.add(slot.id, "quota", codename)
+            logging.warning(f"Client {slot.id} reached the daily limit for {codename}, quarantined for {backoff:.0f}s.")
         else:
-            self.AI_MODEL = model
+            logging.warning(f"Client {slot.id} reached the daily limit for {codename}.")
+
+    def forget(self, slot: ClientSlot):
+        for key in [key for key in self.remaining if key[0] == slot.id]:
+            del self.remaining[key]
+            self.exhausted.discard(key)
+        self.refreshed_at.pop(slot.id, None)
+
+    async def refresh(self, slot: ClientSlot):
+        try:
+            quotas = await self.executor.run(slot.client, _read_quotas, slot.client, self.codenames)
+        except Exception as e:
+            logging.error(f"Failed to refresh quota for client {slot.id}: {str(e)}")
+            return
+        for codename, remaining in quotas.items():
+            self.update(slot, codename, remaining)
+        self.refreshed_at[slot.id] = time.time()
+
+    async def run(self, pool: "ClientPool"):
+        """Refresh every slot once per interval, spread out with jitter."""
+        while True:
+            slots = list(pool.slots)
+            for slot in slots:
+                await self.refresh(slot)
+                spacing = self.interval / max(len(slots), 1)
+                await asyncio.sleep(spacing * random.uniform(1 - self.jitter, 1 + self.jitter))
+            if not slots:
+                await asyncio.sleep(min(self.interval, 5))
+
+    def stats(self) -> dict:
+        totals = {}
+        for (_, codename), remaining in self.remaining.items():
+            if remaining is not None:
+                totals[codename] = totals.get(codename, 0) + max(remaining, 0)
+        return {
+            "remaining": totals,
+            "exhausted": sorted(f"{slot_id}:{codename}" for slot_id, codename in self.exhausted),
+        }
+
+
+class QuotaSnapshot:
+    """Reads the scanner's snapshot file, again only when it has changed."""
+
+    def __init__(self, path: str = QUOTA_SNAPSHOT_FILE):
+        self.path = path
+        self.generated_at = None
+        self._signature = None
+        self._rows = {}
+
+    def rows(self) -> dict:
+        """Blocking: ``{(token_id, codename): (remaining, updated)}``."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._signature, self._rows, self.generated_at = None, {}, None
+            return self._rows
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            try:
+                with open(self.path, "r") as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to read quota snapshot {self.path}: {str(e)}")
+                return self._rows
+            self._rows = {
+                (token, codename): (remaining, entry.get("scanned_at") or 0)
+                for token, entry in snapshot.get("tokens", {}).items()
+                for codename, remaining in entry.get("remaining", {}).items()
+            }
+            self.generated_at = snapshot.get("generated_at")
+            self._signature = signature
+        return self._rows
+
 
-    def _get_current_token(self):
-        return self.POE_TOKENS[self.current_token_index]
+class ClientPool:
+    """Hands out client slots per request, least loaded first.
 
-    def _get_current_proxy(self):
-        return self.PROXIES[self.current_proxy_index]
+    Selection uses each slot's in-flight count and recent latency, so busy
+    or slow accounts get less traffic. Nothing here is shared between
+    requests except those counters, so concurrent requests for different
+    models cannot interfere.
+    """
 
-    def _rotate_token(self):
-        if len(self.bad_tokens) == len(self.POE_TOKENS):
-            self.bad_tokens = (
-                []
-            )  # Reset the bad tokens list if all tokens have been marked as bad
+    def __init__(
+        self,
+        slots: List[ClientSlot] = None,
+        quota: QuotaTracker = None,
+        quarantine: TokenQuarantine = None,
+        per_client: int = CLIENT_CONCURRENCY,
+        affinity=None,
+    ):
+        self.slots = list(slots or [])
+        self.quota = quota
+        self.quarantine = quarantine
+        self.per_client = per_client
+        self.affinity = affinity  # ConversationAffinity, to spare chats holding a conversation
+
+    def __len__(self):
+        return len(self.slots)
+
+    def add(self, slot: ClientSlot):
+        self.slots.append(slot)
+
+    def remove(self, slot: ClientSlot):
+        """Stop handing out ``slot``. Requests already holding it finish normally."""
+        if slot in self.slots:
+            self.slots.remove(slot)
+
+    def find(self, token: str) -> Optional[ClientSlot]:
+        for slot in self.slots:
+            if slot.token == token:
+                return slot
+        return None
+
+    def eligible(self, codename: str, exclude=()) -> List[ClientSlot]:
+        return [
+            slot
+            for slot in self.slots
+            if slot.id not in exclude
+            and slot.breaker.allows()
+            and (self.quota is None or self.quota.is_available(slot, codename))
+            and (self.quarantine is None or self.quarantine.allows(slot.id, codename))
+        ]
 
-        self.current_token_index = (self.current_token_index + 1) % len(self.POE_TOKENS)
-        while self._get_current_token() in self.bad_tokens:  # Skip over bad tokens
-            self.current_token_index = (self.current_token_index + 1) % len(
-                self.POE_TOKENS
+    def pick(self, codename: str, exclude=(), prefer: str = None, idle: bool = False) -> Optional[ClientSlot]:
+        candidates = self.eligible(codename, exclude)
+        if idle:
+            candidates = [slot for slot in candidates if slot.in_flight == 0]
+        if not candidates:
+            return None
+        if prefer is not None:
+            for slot in candidates:
+                if slot.id == prefer:
+                    return slot
+        # Free slots first: a saturated one would make the request wait for
+        # its running calls, however fast it usually is. Then slots whose chat
+        # for this bot holds no conversation (or the least recently used one),
+        # since sending there discards it. Slots without a latency sample yet
+        # count as average, so one fast measurement does not pull all traffic
+        # onto that slot.
+        default_latency = self.mean_latency()
+
+        def rank(slot):
+            used = self.affinity.last_used(slot.id, codename) if self.affinity is not None else None
+            return (
+                slot.in_flight >= self.per_client,
+                used is not None,
+                used or 0.0,
+                slot.expected_wait(default_latency),
             )
 
-    def _rotate_proxy(self):
-        self.current_proxy_index = (self.current_proxy_index + 1) % len(self.PROXIES)
-        if self.current_proxy_index == 0:
-            PROXY_LIST_FILE = "proxies.txt"  # Replace with the actual file path
-            self.PROXIES = load_proxies_from_file(PROXY_LIST_FILE)  # Reload proxies
+        return min(candidates, key=rank)
+
+    def mean_latency(self) -> float:
+        latencies = [slot.latency for slot in self.slots if slot.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else ClientSlot.DEFAULT_LATENCY
+
+    @contextlib.asynccontextmanager
+    async def lease(self, codename: str, exclude=(), prefer: str = None, idle: bool = False):
+        """Lease the best slot for ``codename`` for the duration of a request.
+
+        ``prefer`` names a slot to use if it is still eligible, even when a
+        less loaded one exists. With ``idle`` only slots with nothing in
+        flight are considered.
+        """
+        slot = self.pick(codename, exclude, prefer, idle)
+        if slot is None:
+            raise NoClientAvailable(f"No available clients for model {codename}")
+        slot.breaker.on_lease()
+        slot.in_flight += 1
+        try:
+            yield slot
+        finally:
+            slot.in_flight -= 1
+            slot.breaker.probing = False  # an unfinished probe decides nothing
+
+    def stats(self) -> List[dict]:
+        return [slot.stats() for slot in self.slots]
+
+
+class Overloaded(Exception):
+    """The request could not be admitted; the caller should retry later."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Set by streaming endpoints to an asyncio.Event that admit() sets once the
+# request has left the queue.
+admission_notice = contextvars.ContextVar("admission_notice", default=None)
 
-    async def instruct(self, messages: List[Message], tokens: int = 0, max_retries=3):
-        for _ in range(max_retries):
+
+class AdmissionController:
+    """Caps running upstream requests and queues the rest, within limits.
+
+    Capacity follows the number of clients in the pool. The wait queue holds
+    ``queue_per_client`` requests per client overall, and per model only as
+    many as the clients still able to serve that model. Requests that do not
+    fit, or that wait longer than ``max_wait``, raise Overloaded.
+    """
+
+    # Weight of the newest sample in the queue wait moving average.
+    WAIT_ALPHA = 0.2
+
+    def __init__(
+        self,
+        pool: ClientPool,
+        per_client: int = CLIENT_CONCURRENCY,
+        queue_per_client: int = QUEUE_PER_CLIENT,
+        max_wait: float = QUEUE_MAX_WAIT,
+    ):
+        self.pool = pool
+        self.per_client = per_client
+        self.queue_per_client = queue_per_client
+        self.max_wait = max_wait
+        self.running = 0
+        self._waiters = deque()
+        self.queued_by_model = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_avg = 0.0
+        self.wait_max = 0.0
+
+    def capacity(self) -> int:
+        return len(self.pool) * self.per_client
+
+    def queue_limit(self) -> int:
+        return max(len(self.pool), 1) * self.queue_per_client
+
+    def model_queue_limit(self, codename: str) -> int:
+        return len(self.pool.eligible(codename)) * self.queue_per_client
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has probably drained enough to retry."""
+        latency = self.pool.mean_latency()
+        rounds = (len(self._waiters) + 1) / max(self.capacity(), 1)
+        return max(1, math.ceil(rounds * latency))
+
+    def _wake(self):
+        while self._waiters and self.running < self.capacity():
+            future = self._waiters.popleft()
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+
+    def _release(self):
+        self.running -= 1
+        self._wake()
+
+    def _record_wait(self, waited: float):
+        self.wait_avg += self.WAIT_ALPHA * (waited - self.wait_avg)
+        self.wait_max = max(self.wait_max, waited)
+        metrics.queue_wait.observe(waited)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise Overloaded(reason, self.retry_after())
+
+    @contextlib.asynccontextmanager
+    async def admit(self, codename: str):
+        """Hold one running slot for the duration of the block."""
+        self._wake()
+        if self.running < self.capacity() and not self._waiters:
+            self.running += 1
+        else:
+            if len(self._waiters) >= self.queue_limit():
+                self._reject("Server is busy, request queue is full.")
+            if self.queued_by_model.get(codename, 0) >= self.model_queue_limit(codename):
+                self._reject(f"Server is busy, request queue for model {codename} is full.")
+
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            self.queued_by_model[codename] = self.queued_by_model.get(codename, 0) + 1
+            start = time.monotonic()
             try:
-                self._rotate_proxy()  # Rotate the proxy for every request
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except asyncio.TimeoutError:
+                # wait_for can time out after _wake() already handed us a slot;
+                # that slot is ours to use (or it would never be released).
+                if not future.done():
+                    self.timed_out += 1
+                    self._reject(f"Timed out after {self.max_wait:.0f}s waiting in the request queue.")
+            except asyncio.CancelledError:
+                if future.done():
+                    self._release()  # we were handed a slot but can no longer use it
+                raise
+            finally:
+                if not future.done():
+                    future.cancel()
+                    self._waiters.remove(future)
+                self.queued_by_model[codename] -= 1
+                self._record_wait(time.monotonic() - start)
+                trace_phase("queue", time.monotonic() - start)
+
+        self.admitted += 1
+        notice = admission_notice.get()
+        if notice is not None:
+            notice.set()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "capacity": self.capacity(),
+            "queue_depth": len(self._waiters),
+            "queue_limit": self.queue_limit(),
+            "queued_by_model": {k: v for k, v in self.queued_by_model.items() if v},
+            "wait_avg": round(self.wait_avg, 3),
+            "wait_max": round(self.wait_max, 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
 
-                client = self.check_remaining_messages()
-                if client is None:
-                    raise Exception("No available clients for the current model")
 
-                if self.AI_MODEL not in client.bot_names:
-                    self.AI_MODEL = client.get_bot_by_codename(self.AI_MODEL)
+def render_transcript(messages: List[Message]) -> str:
+    """Flatten a conversation into one prompt for a fresh Poe chat."""
+    if len(messages) == 1:
+        return messages[0].content
+    return "\n\n".join(f"{msg.role.capitalize()}: {msg.content}" for msg in messages)
+
+
+class ContextTooLarge(ValueError):
+    """The prompt does not fit the model's context window."""
+
+
+_token_estimates = OrderedDict()
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast, slightly generous token count for ``text``.
+
+    About 3.5 ASCII characters make a token, and any other character counts
+    as one. Results are cached by the text's hash, since every turn of a
+    conversation resends the earlier messages.
+    """
+    key = (len(text), hash(text))
+    estimate = _token_estimates.get(key)
+    if estimate is not None:
+        _token_estimates.move_to_end(key)
+        return estimate
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    estimate = math.ceil(ascii_chars / 3.5) + len(text) - ascii_chars
+    _token_estimates[key] = estimate
+    if len(_token_estimates) > TOKEN_CACHE_SIZE:
+        _token_estimates.popitem(last=False)
+    return estimate
+
+
+def conversation_tokens(messages: List[Message]) -> int:
+    # Each message also costs its "Role: " prefix and separator in the transcript.
+    return sum(estimate_tokens(msg.content) + 4 for msg in messages)
+
+
+def fit_context(messages: List[Message], codename: str, overflow: str = CONTEXT_OVERFLOW):
+    """Make sure the prompt fits before anything is sent to Poe.
+
+    Returns the messages and codename to use. A prompt too large for the
+    model moves to its larger-context sibling when there is one. Otherwise,
+    with ``overflow`` set to "trim", the oldest messages after any system
+    messages are dropped until it fits; else ContextTooLarge is raised.
+    """
+    needed = conversation_tokens(messages) + CONTEXT_REPLY_RESERVE
+    limit = CONTEXT_LIMITS.get(codename)
+    if limit is None or needed <= limit:
+        return messages, codename
+
+    sibling = CONTEXT_UPGRADES.get(codename)
+    if sibling is not None and needed <= CONTEXT_LIMITS[sibling]:
+        logging.info(f"Prompt of ~{needed} tokens is too large for {codename}, using {sibling}.")
+        return messages, sibling
+    if sibling is not None:
+        codename, limit = sibling, CONTEXT_LIMITS[sibling]
+
+    if overflow == "trim":
+        droppable = [i for i, msg in enumerate(messages) if msg.role != "system"][:-1]
+        dropped = set()
+        for i in droppable:
+            if needed <= limit:
+                break
+            dropped.add(i)
+            needed -= estimate_tokens(messages[i].content) + 4
+        if needed <= limit:
+            logging.info(f"Trimmed the prompt to ~{needed} tokens to fit {codename}.")
+            return [msg for i, msg in enumerate(messages) if i not in dropped], codename
+
+    raise ContextTooLarge(
+        f"The prompt is about {needed} tokens (including {CONTEXT_REPLY_RESERVE} for the reply), "
+        f"more than the {limit} tokens {codename} can take."
+    )
 
-                last_user_message = [msg for msg in messages if msg.role == "user"][-1].content
 
-                if last_user_message.strip():  # Check if the message is not empty
-                    for chunk in client.send_message(
-        chatbot=self.AI_MODEL, message=last_user_message, async_recv = True, with_chat_break = True
-                     ):
-                        pass
-                        self._rotate_client()  # Rotate to the next client for the next request
-                        return {"role": "assistant", "content": chunk["text"] + "\n---\n"}  # add a chat break at the end of the message
-                else:
-                    logging.warning("Attempted to send an empty message, skipping.")
-                    return {"role": "assistant", "content": ""}
+class ConversationAffinity:
+    """Remembers which Poe chat holds which conversation.
+
+    A Poe account has one chat per bot, so a (slot, codename) pair can hold
+    a single conversation at a time. After a reply, the fingerprint of the
+    whole exchange is mapped to the pair that produced it. A follow-up whose
+    earlier messages hash to that fingerprint is sent to the same pair with
+    only the new message and no chat break. Any other send to the pair
+    invalidates it. Idle entries are evicted by LRU size and TTL.
+    """
+
+    def __init__(self, max_size: int = AFFINITY_SIZE, ttl: float = AFFINITY_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._threads = OrderedDict()
+        self._owners = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(codename: str, turns) -> str:
+        digest = hashlib.sha256(codename.encode())
+        for role, content in turns:
+            digest.update(b"\0" + role.strip().lower().encode() + b"\0" + content.strip().encode())
+        return digest.hexdigest()
+
+    def take(self, codename: str, history: List[Message]) -> Optional[str]:
+        """Return the slot id holding ``history`` and reserve that chat, if any."""
+        key = self.fingerprint(codename, [(msg.role, msg.content) for msg in history])
+        entry = self._threads.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        slot_id, _, expires = entry
+        if expires < time.monotonic() or self._owners.get((slot_id, codename)) != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return slot_id
+
+    def last_used(self, slot_id: str, codename: str) -> Optional[float]:
+        """When the pair's chat was last used for a live conversation, None if it holds none."""
+        key = self._owners.get((slot_id, codename))
+        if key is None:
+            return None
+        entry = self._threads.get(key)
+        if entry is None:
+            return time.monotonic()  # taken by a follow-up in progress
+        expires = entry[2]
+        if expires < time.monotonic():
+            return None
+        return expires - self.ttl
+
+    def claim(self, slot_id: str, codename: str):
+        """Mark the pair's chat as being changed by a send in progress."""
+        previous = self._owners.pop((slot_id, codename), None)
+        if previous is not None:
+            self._threads.pop(previous, None)
+
+    def record(self, slot_id: str, codename: str, turns):
+        """Remember that the pair's chat now holds exactly ``turns``."""
+        key = self.fingerprint(codename, turns)
+        self._owners[(slot_id, codename)] = key
+        self._threads[key] = (slot_id, codename, time.monotonic() + self.ttl)
+        self._threads.move_to_end(key)
+        while len(self._threads) > self.max_size:
+            _, (old_slot, old_codename, _) = self._threads.popitem(last=False)
+            self._owners.pop((old_slot, old_codename), None)
+
+    def stats(self) -> dict:
+        return {"threads": len(self._threads), "hits": self.hits, "misses": self.misses}
+
+
+class _LeaderCancelled(Exception):
+    """The request computing a shared answer went away before finishing."""
+
+
+class ResponseCache:
+    """LRU + TTL cache of finished answers, with single-flight coalescing.
+
+    Identical requests that arrive while an answer is still being generated
+    wait for that one upstream call instead of starting their own. If the
+    request doing the work is cancelled, one of the waiters takes over.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(codename: str, messages: List[Message]) -> str:
+        normalized = [[msg.role.strip().lower(), msg.content.strip()] for msg in messages]
+        payload = json.dumps([codename, normalized], ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, content = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content
+
+    def put(self, key: str, content: str):
+        self._entries[key] = (time.monotonic() + self.ttl, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pending(self, key: str) -> bool:
+        return key in self._in_flight
+
+    def begin(self, key: str) -> asyncio.Future:
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        return future
+
+    def finish(self, key: str, content: str):
+        future = self._in_flight.pop(key)
+        future.set_result(content)
+        if content:
+            self.put(key, content)
+
+    def abort(self, key: str, error: BaseException):
+        future = self._in_flight.pop(key)
+        future.set_exception(error)
+        future.exception()  # waiters are optional, don't log it as unretrieved
+
+    async def get_or_compute(self, key: str, compute):
+        """Return the cached answer for ``key`` or compute it exactly once."""
+        while True:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            waiting = self._in_flight.get(key)
+            if waiting is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(waiting)
+            except _LeaderCancelled:
+                continue
+
+        self.begin(key)
+        try:
+            content = await compute()
+        except asyncio.CancelledError:
+            self.abort(key, _LeaderCancelled())
+            raise
+        except Exception as e:
+            self.abort(key, e)
+            raise
+        self.finish(key, content)
+        return content
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+        }
 
-            except Exception as e:  # Catch all other exceptions
-                logging.error(f"Unexpected error during instruction: {str(e)}")
-                self._rotate_token()
-                await asyncio.sleep(2)
-                if str(e) == "Response timed out.":
-                    for retry in range(max_retries):  # Don't wait on last iteration
-                        logging.warning("Response timed out. Retrying...")
-                        await asyncio.sleep(2)  # Wait for 2 seconds before retrying
+
+class SharedState:
+    """Token leases, quotas and bad-token marks shared by all workers.
+
+    Backed by one SQLite database in WAL mode. Every worker calls ``sync``
+    periodically: it renews the worker's heartbeat and leases, releases
+    leases above its fair share and claims free tokens up to that share,
+    taking them from workers above their share if none are free. Shares
+    differ by at most one token: the lowest pids get the remainder. The
+    methods are blocking and are run on the upstream executor.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, heartbeat REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS leases (token_id TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS quota (token_id TEXT NOT NULL, codename TEXT NOT NULL,"
+        " remaining INTEGER, updated REAL NOT NULL, PRIMARY KEY (token_id, codename))",
+        "CREATE TABLE IF NOT EXISTS bad_tokens (token_id TEXT PRIMARY KEY, until REAL NOT NULL, reason TEXT)",
+        "CREATE TABLE IF NOT EXISTS rate_usage (caller TEXT NOT NULL, codename TEXT NOT NULL, owner INTEGER NOT NULL,"
+        " requests REAL NOT NULL, messages REAL NOT NULL, PRIMARY KEY (caller, codename, owner))",
+    )
+
+    def __init__(self, path: str = STATE_DB, lease_ttl: float = LEASE_INTERVAL * LEASE_MISSES):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def register(self, owner: int):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (owner, time.time()))
+
+    def sync(self, owner: int, token_ids: List[str], quota_rows=(), bad_rows=()) -> set:
+        """Renew, rebalance and claim leases; return the token ids ``owner`` holds."""
+        now = time.time()
+        wanted = set(token_ids)
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (owner, now))
+            conn.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.lease_ttl,))
+            conn.execute(
+                "DELETE FROM leases WHERE expires < ? OR owner NOT IN (SELECT pid FROM workers)", (now,)
+            )
+            conn.execute("DELETE FROM bad_tokens WHERE until < ?", (now,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO quota VALUES (?, ?, ?, ?)",
+                [(token, codename, remaining, now) for token, codename, remaining in quota_rows],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO bad_tokens VALUES (?, ?, ?)", list(bad_rows)
+            )
+
+            workers = [row[0] for row in conn.execute("SELECT pid FROM workers ORDER BY pid")]
+            base, extra = divmod(len(token_ids), len(workers))
+            shares = {pid: base + (1 if rank < extra else 0) for rank, pid in enumerate(workers)}
+            share = shares[owner]
+            held = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT token_id FROM leases WHERE owner = ? ORDER BY token_id", (owner,)
+                )
+            ]
+            mine = [token for token in held if token in wanted][:share]
+            released = [token for token in held if token not in mine]
+            conn.executemany("DELETE FROM leases WHERE token_id = ?", [(token,) for token in released])
+
+            if len(mine) < share:
+                taken = {row[0] for row in conn.execute("SELECT token_id FROM leases")}
+                bad = {row[0] for row in conn.execute("SELECT token_id FROM bad_tokens")}
+                for token in token_ids:
+                    if len(mine) >= share:
+                        break
+                    if token not in taken and token not in bad:
+                        mine.append(token)
+                        taken.add(token)
+
+            if len(mine) < share:
+                # Nothing free: take the surplus of workers above their share.
+                # They notice the lost leases on their next sync.
+                bad = {row[0] for row in conn.execute("SELECT token_id FROM bad_tokens")}
+                leases = {}
+                for token, holder in conn.execute("SELECT token_id, owner FROM leases ORDER BY token_id"):
+                    if holder != owner and token in wanted and token not in bad:
+                        leases.setdefault(holder, []).append(token)
+                for holder, tokens in sorted(leases.items(), key=lambda item: -len(item[1])):
+                    surplus = tokens[shares.get(holder, 0):]
+                    for token in surplus[: share - len(mine)]:
+                        mine.append(token)
+                    if len(mine) >= share:
+                        break
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                [(token, owner, now + self.lease_ttl) for token in mine],
+            )
+        return set(mine)
+
+    def quotas(self) -> dict:
+        """``{(token_id, codename): (remaining, updated)}`` as last reported by any worker."""
+        with contextlib.closing(self._connect()) as conn:
+            return {
+                (token, codename): (remaining, updated)
+                for token, codename, remaining, updated in conn.execute(
+                    "SELECT token_id, codename, remaining, updated FROM quota"
+                )
+            }
+
+    def exchange_usage(self, owner: int, rows, removed=()) -> list:
+        """Publish ``owner``'s rate-limit totals and return the other live workers'.
+
+        ``rows`` are ``(caller, codename, requests, messages)`` totals;
+        ``removed`` are ``(caller, codename)`` pairs ``owner`` has forgotten.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM rate_usage WHERE caller = ? AND codename = ? AND owner = ?",
+                [(caller, codename, owner) for caller, codename in removed],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO rate_usage VALUES (?, ?, ?, ?, ?)",
+                [(caller, codename, owner, requests, messages) for caller, codename, requests, messages in rows],
+            )
+            conn.execute("DELETE FROM rate_usage WHERE owner NOT IN (SELECT pid FROM workers)")
+            return conn.execute(
+                "SELECT caller, codename, owner, requests, messages FROM rate_usage WHERE owner != ?", (owner,)
+            ).fetchall()
+
+    def release(self, owner: int):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rate_usage WHERE owner = ?", (owner,))
+            conn.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+            conn.execute("DELETE FROM workers WHERE pid = ?", (owner,))
+
+    def stats(self) -> dict:
+        with contextlib.closing(self._connect()) as conn:
+            workers = conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+            leases = dict(conn.execute("SELECT owner, COUNT(*) FROM leases GROUP BY owner").fetchall())
+            bad = conn.execute("SELECT COUNT(*) FROM bad_tokens").fetchone()[0]
+        return {"workers": workers, "leases": leases, "bad_tokens": bad}
+
+
+class RateLimited(Overloaded):
+    """A caller went over its rate limit."""
+
+    def __init__(self, message: str, retry_after: int, headers: dict):
+        super().__init__(message, retry_after)
+        self.headers = headers
+
+
+class TokenBucket:
+    """Holds up to ``capacity`` units and refills at ``capacity`` per ``period`` seconds."""
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        """Seconds until ``amount`` units are available."""
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def reset_in(self) -> float:
+        """Seconds until the bucket is full again."""
+        return max(0.0, (self.capacity - self.level) / self.rate)
+
+
+def _duration(seconds: float) -> str:
+    return f"{seconds:.3g}s"
+
+
+class RateLimiter:
+    """Token-bucket limits per caller and model, in requests and upstream messages.
+
+    ``limits`` maps a codename (or "default") to ``{"requests": n,
+    "messages": m}`` per RATE_LIMIT_PERIOD seconds; a missing figure is not
+    limited. A request costs one request and as many messages as it sends
+    to Poe (one for a chat, one per item for a batch).
+
+    Checks only touch this worker's buckets. With shared state, every
+    worker periodically publishes how much each caller has spent and
+    charges what the other workers spent to its own buckets, so callers get
+    the configured rate over all workers, give or take one sync interval.
+    """
+
+    def __init__(self, limits: dict, shared: SharedState = None, period: float = RATE_LIMIT_PERIOD):
+        self.limits = {
+            name if name == "default" else resolve_model(name): limit for name, limit in limits.items()
+        }
+        self.shared = shared
+        self.period = period
+        self.buckets = {}  # (caller, codename) -> [requests bucket, messages bucket]
+        self.spent = {}  # (caller, codename) -> [requests, messages] spent here, ever
+        self.seen = {}  # (caller, codename, owner) -> [requests, messages] seen from other workers
+        self.limited = 0
+        self._task = None
+
+    def enabled(self) -> bool:
+        return bool(self.limits)
+
+    def _limit(self, codename: str) -> dict:
+        return self.limits.get(codename) or self.limits.get("default") or {}
+
+    def _buckets(self, caller: str, codename: str) -> list:
+        buckets = self.buckets.get((caller, codename))
+        if buckets is None:
+            limit = self._limit(codename)
+            buckets = self.buckets[(caller, codename)] = [
+                TokenBucket(limit[kind], self.period) if limit.get(kind) else None
+                for kind in ("requests", "messages")
+            ]
+        return buckets
+
+    def acquire(self, caller: str, costs: dict) -> dict:
+        """Take one request and ``costs[codename]`` messages for each model.
+
+        Nothing is taken unless everything fits. Returns the rate-limit
+        headers for the first model; raises RateLimited otherwise.
+        """
+        if not self.limits or not costs:
+            return {}
+        now = time.monotonic()
+        checked = []
+        wait = 0.0
+        for codename, messages in costs.items():
+            buckets = self._buckets(caller, codename)
+            for bucket, amount in zip(buckets, (1, messages)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_for(amount))
+            checked.append((codename, buckets, messages))
+        if wait > 0:
+            self.limited += 1
+            retry_after = max(1, math.ceil(wait))
+            headers = self._headers(checked[0][1])
+            headers["Retry-After"] = str(retry_after)
+            raise RateLimited(f"Rate limit reached for {checked[0][0]}, retry in {retry_after}s.", retry_after, headers)
+        for codename, buckets, messages in checked:
+            spent = self.spent.setdefault((caller, codename), [0, 0])
+            for i, amount in enumerate((1, messages)):
+                if buckets[i] is not None:
+                    buckets[i].level -= amount
+                spent[i] += amount
+        return self._headers(checked[0][1])
+
+    @staticmethod
+    def _headers(buckets: list) -> dict:
+        headers = {}
+        for kind, bucket in zip(("requests", "messages"), buckets):
+            if bucket is not None:
+                headers[f"x-ratelimit-limit-{kind}"] = str(int(bucket.capacity))
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(bucket.level)))
+                headers[f"x-ratelimit-reset-{kind}"] = _duration(bucket.reset_in())
+        return headers
+
+    def _charge(self, rows):
+        """Charge what other workers spent since the last sync to our buckets."""
+        now = time.monotonic()
+        for caller, codename, owner, requests, messages in rows:
+            previous = self.seen.get((caller, codename, owner), (0, 0))
+            totals = (requests, messages)
+            self.seen[(caller, codename, owner)] = totals
+            buckets = self._buckets(caller, codename)
+            for bucket, total, before in zip(buckets, totals, previous):
+                delta = total - before if total >= before else total  # the other worker restarted
+                if bucket is not None and delta > 0:
+                    bucket.refill(now)
+                    bucket.level -= delta
+
+    def _evict(self) -> list:
+        """Forget callers whose buckets are full again; return their keys."""
+        now = time.monotonic()
+        idle = []
+        for key, buckets in self.buckets.items():
+            for bucket in buckets:
+                if bucket is not None:
+                    bucket.refill(now)
+            if all(bucket is None or bucket.level >= bucket.capacity for bucket in buckets):
+                idle.append(key)
+        for key in idle:
+            del self.buckets[key]
+            self.spent.pop(key, None)
+        idle_keys = set(idle)
+        self.seen = {key: value for key, value in self.seen.items() if key[:2] not in idle_keys}
+        return idle
+
+    async def run(self, executor: UpstreamExecutor, interval: float = RATE_LIMIT_SYNC_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            removed = self._evict()
+            if self.shared is None:
+                continue
+            rows = [(caller, codename, spent[0], spent[1]) for (caller, codename), spent in self.spent.items()]
+            try:
+                others = await executor.call(self.shared.exchange_usage, os.getpid(), rows, removed)
+            except sqlite3.Error as e:
+                logging.error(f"Failed to share rate limit usage: {str(e)}")
+                continue
+            self._charge(others)
+
+    def start(self, executor: UpstreamExecutor):
+        if self.limits:
+            self._task = asyncio.create_task(self.run(executor))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"limits": self.limits, "callers": len({caller for caller, _ in self.buckets}), "limited": self.limited}
+
+
+def caller_key(request: Request) -> str:
+    """Who a request counts against: its API key, or its address without one."""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer ") and authorization[7:].strip():
+        return "key:" + token_id(authorization[7:].strip())
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+class HedgePolicy:
+    """Decides when a slow upstream call gets a second, hedged copy.
+
+    The delay per model is a quantile of its recent times to first piece,
+    recomputed every few samples. Calls and hedges are counted over a
+    sliding window (both counts are halved now and then), and a hedge is
+    only allowed while hedges stay under ``budget`` of the calls.
+    """
+
+    WINDOW = 200
+    MIN_SAMPLES = 20
+    RECOMPUTE_EVERY = 10
+    DECAY_AT = 1000
+
+    def __init__(self, budget: float = HEDGE_BUDGET, quantile: float = HEDGE_QUANTILE, min_delay: float = HEDGE_MIN_DELAY):
+        self.budget = budget
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.samples = {}
+        self.observed = {}
+        self.delays = {}
+        self.calls = 0
+        self.hedges = 0
+        self.hedges_total = 0
+        self.hedge_wins = 0
+
+    def observe(self, codename: str, seconds: float):
+        samples = self.samples.get(codename)
+        if samples is None:
+            samples = self.samples[codename] = deque(maxlen=self.WINDOW)
+        samples.append(seconds)
+        observed = self.observed[codename] = self.observed.get(codename, 0) + 1
+        if len(samples) >= self.MIN_SAMPLES and observed % self.RECOMPUTE_EVERY == 0:
+            ordered = sorted(samples)
+            self.delays[codename] = max(self.min_delay, ordered[int(self.quantile * (len(ordered) - 1))])
+
+    def delay(self, codename: str) -> Optional[float]:
+        """Seconds to wait for the first piece before hedging, None for never."""
+        if self.budget <= 0:
+            return None
+        return self.delays.get(codename)
+
+    def record_call(self):
+        self.calls += 1
+        if self.calls >= self.DECAY_AT:
+            self.calls //= 2
+            self.hedges //= 2
+
+    def can_hedge(self) -> bool:
+        return self.hedges + 1 <= self.budget * self.calls
+
+    def record_hedge(self):
+        self.hedges += 1
+        self.hedges_total += 1
+
+    def stats(self) -> dict:
+        return {
+            "budget": self.budget,
+            "delays": {codename: round(delay, 3) for codename, delay in self.delays.items()},
+            "hedges": self.hedges_total,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class PoeProvider:
+    def __init__(
+        self,
+        POE_TOKENS: list = None,
+        PROXIES: list = None,
+        AI_MODEL: str = "chinchilla",
+        **kwargs,
+    ):
+        self.POE_TOKENS = POE_TOKENS or []
+        self.PROXIES = PROXIES or []
+        self.AI_MODEL = AI_MODEL.lower()  # used when a request names no model
+        self.executor = kwargs.get("executor") or UpstreamExecutor()
+        self.quarantine = TokenQuarantine()
+        self.quota = QuotaTracker(self.executor, quarantine=self.quarantine)
+        self.quota_snapshot = kwargs.get("quota_snapshot") or QuotaSnapshot()
+        affinity_size = kwargs.get("affinity_size", AFFINITY_SIZE)
+        self.affinity = ConversationAffinity(affinity_size) if affinity_size > 0 else None
+        self.pool = ClientPool(quota=self.quota, quarantine=self.quarantine, affinity=self.affinity)
+        self.admission = AdmissionController(self.pool)
+        cache_size = kwargs.get("cache_size", CACHE_SIZE)
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        self.hedging = kwargs.get("hedging") or HedgePolicy()
+        self.shared = kwargs.get("shared")
+        self.owned = None  # token ids leased to this worker; None means all of them
+        self._tasks = []
+        self._background = set()
+        self.connecting = {}
+        self._connect_limit = asyncio.Semaphore(kwargs.get("connect_concurrency", CONNECT_CONCURRENCY))
+
+    def start(self, tokens_file: str = None, proxies_file: str = None):
+        """Start the background tasks. Must be called from the event loop.
+
+        If file paths are given they are watched, and the pool follows any
+        change to them.
+        """
+        self._tasks.append(asyncio.create_task(self.quota.run(self.pool)))
+        self._tasks.append(asyncio.create_task(self.run_quarantine(tokens_file)))
+        if tokens_file and proxies_file:
+            self._tasks.append(asyncio.create_task(self.watch_files(tokens_file, proxies_file)))
+        if self.shared is not None:
+            self._tasks.append(asyncio.create_task(self.coordinate()))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _connect_pair(self, token: str, proxy: Optional[str]):
+        pair = (token, proxy)
+        task = self._spawn(self.add_client(token, proxy))
+        self.connecting[pair] = task
+        task.add_done_callback(lambda _: self.connecting.pop(pair, None))
+        return task
+
+    def _assigned_pairs(self, tokens: List[str], proxies: List[str]) -> list:
+        pairs = list(zip(tokens, proxies))
+        if self.owned is None:
+            return pairs
+        return [(token, proxy) for token, proxy in pairs if token_id(token) in self.owned]
+
+    def _shared_rows(self):
+        quota_rows = [
+            (slot_id, codename, remaining)
+            for (slot_id, codename), remaining in self.quota.remaining.items()
+        ]
+        now, wall = time.monotonic(), time.time()
+        bad_rows = [
+            (slot.id, wall + slot.breaker.open_until - now, "circuit_open")
+            for slot in self.pool.slots
+            if slot.breaker.state == "open" and slot.breaker.open_until > now
+        ]
+        bad_rows += [
+            (token, entry["until"], entry["reason"])
+            for (token, codename), entry in self.quarantine.entries.items()
+            if codename is None
+        ]
+        return quota_rows, bad_rows
+
+    async def _sync_leases(self):
+        quota_rows, bad_rows = self._shared_rows()
+        owned = await self.executor.call(
+            self.shared.sync,
+            os.getpid(),
+            [token_id(token) for token in self.POE_TOKENS],
+            quota_rows,
+            bad_rows,
+        )
+        if owned != self.owned:
+            logging.info(f"Worker {os.getpid()} now holds {len(owned)} of {len(self.POE_TOKENS)} tokens.")
+            self.owned = owned
+            return True
+        return False
+
+    async def claim_tokens(self):
+        """Register with the other workers and take this worker's share of tokens."""
+        if self.shared is None:
+            return
+        await self.executor.call(self.shared.register, os.getpid())
+        await asyncio.sleep(LEASE_STARTUP_GRACE)
+        await self._sync_leases()
+
+    async def coordinate(self, interval: float = LEASE_INTERVAL):
+        """Keep this worker's token leases current and follow rebalancing."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = await self._sync_leases()
+            except sqlite3.Error as e:
+                logging.error(f"Failed to sync token leases: {str(e)}")
+                continue
+            if changed:
+                self.reconcile(self.POE_TOKENS, self.PROXIES)
+
+    async def run_quarantine(self, tokens_file: str = None):
+        """Release quarantined tokens when they are due, and keep the saved copy current.
+
+        Tokens that were quarantined because they could not connect are
+        connected again on release.
+        """
+        path = quarantine_path(tokens_file) if tokens_file else None
+        while True:
+            self.quarantine.changed.clear()
+            try:
+                await asyncio.wait_for(self.quarantine.changed.wait(), self.quarantine.next_release())
+            except asyncio.TimeoutError:
+                pass
+            released = self.quarantine.release_due()
+            connected = {slot.id for slot in self.pool.slots}
+            if any(codename is None and token not in connected for token, codename in released):
+                self.reconcile(self.POE_TOKENS, self.PROXIES)
+            if path is not None:
+                try:
+                    await self.executor.call(
+                        save_quarantine_to_file, path, self.quarantine.rows(), self.quarantine.lifted_rows()
+                    )
+                except OSError as e:
+                    logging.error(f"Failed to save the token quarantine to {path}: {str(e)}")
+
+    async def connect(self, min_ready: int = MIN_READY_CLIENTS):
+        """Connect a client for every token/proxy pair, in parallel.
+
+        Returns as soon as ``min_ready`` clients are up (or every attempt has
+        finished); the rest keep connecting in the background.
+        """
+        pairs = [
+            (token, proxy)
+            for token, proxy in self._assigned_pairs(self.POE_TOKENS, self.PROXIES)
+            if not self.quarantine.blocks_connect(token_id(token))
+        ]
+        target = min(min_ready, len(pairs))
+        ready = asyncio.Event()
+        pending = len(pairs)
+        if target <= 0:
+            ready.set()
+
+        def _connected(_):
+            nonlocal pending
+            pending -= 1
+            if len(self.pool) >= target or pending == 0:
+                ready.set()
+
+        for token, proxy in pairs:
+            self._connect_pair(token, proxy).add_done_callback(_connected)
+
+        await ready.wait()
+        logging.info(
+            f"{len(self.pool)} of {len(pairs)} clients ready, connecting the rest in the background."
+        )
+
+    def reconcile(self, tokens: List[str], proxies: List[str]):
+        """Bring the pool in line with new token and proxy lists.
+
+        Only clients whose token/proxy pair changed, or whose token lease
+        moved to another worker, are touched: removed pairs are retired, new
+        pairs are connected, everything else keeps running.
+        """
+        self.POE_TOKENS = tokens
+        self.PROXIES = proxies
+        desired = self._assigned_pairs(tokens, proxies)
+        wanted = set(desired)
+        retired = 0
+        for slot in list(self.pool.slots):
+            if (slot.token, slot.proxy) not in wanted:
+                self.pool.remove(slot)
+                self._spawn(self.retire_client(slot))
+                retired += 1
+        for pair, task in list(self.connecting.items()):
+            if pair not in wanted:
+                task.cancel()
+        current = {(slot.token, slot.proxy) for slot in self.pool.slots}
+        added = 0
+        for token, proxy in desired:
+            if (token, proxy) in current or (token, proxy) in self.connecting:
+                continue
+            if self.quarantine.blocks_connect(token_id(token)):
+                continue  # connected again once its quarantine ends
+            self._connect_pair(token, proxy)
+            added += 1
+        logging.info(f"Client pool updated: {added} clients added, {retired} retired.")
+
+    async def watch_files(self, tokens_file: str, proxies_file: str, interval: float = WATCH_INTERVAL):
+        """Reload the token and proxy lists whenever either file changes."""
+        paths = (tokens_file, proxies_file)
+        signature = await self.executor.call(_file_signatures, paths)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                latest = await self.executor.call(_file_signatures, paths)
+                if latest == signature:
+                    continue
+                signature = latest
+                tokens = await self.executor.call(load_tokens_from_file, tokens_file)
+                proxies = await self.executor.call(load_proxies_from_file, proxies_file)
+            except OSError as e:
+                logging.error(f"Failed to reload {tokens_file} or {proxies_file}: {str(e)}")
+                continue
+            self.reconcile(tokens, proxies)
+
+    async def add_client(self, token: str, proxy: Optional[str]) -> Optional[ClientSlot]:
+        """Connect a new client and start routing requests to it."""
+        async with self._connect_limit:
+            start = time.monotonic()
+            try:
+                client = await self.executor.call(_connect_client, token, proxy)
+            except Exception as e:
+                backoff = self.quarantine.add(token_id(token), "auth")
+                logging.error(
+                    f"Failed to connect client {token_id(token)}, quarantined for {backoff:.0f}s: {str(e)}"
+                )
+                return None
+        slot = ClientSlot(token, proxy, client)
+        slot.connect_time = time.monotonic() - start
+        # Read its quota once up front so an exhausted token is never routed to.
+        await self.quota.refresh(slot)
+        if slot.connect_time > SLOW_CONNECT_SECONDS:
+            logging.warning(f"Client {slot.id} took {slot.connect_time:.1f}s to connect via {proxy}.")
+        else:
+            logging.info(f"Client {slot.id} connected in {slot.connect_time:.1f}s.")
+        self.pool.add(slot)
+        return slot
+
+    async def retire_client(self, slot: ClientSlot, timeout: float = RETIRE_TIMEOUT):
+        """Stop routing to ``slot`` and close its websocket.
+
+        Requests already running on the slot get up to ``timeout`` seconds
+        to finish first.
+        """
+        self.pool.remove(slot)
+        deadline = time.monotonic() + timeout
+        while slot.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        self.quota.forget(slot)
+        self.executor.forget(slot.client)
+        try:
+            await self.executor.call(slot.client.disconnect_ws)
+        except Exception as e:
+            logging.warning(f"Error while closing client {slot.id}: {str(e)}")
+        logging.info(f"Client {slot.id} retired.")
+
+    async def quota_report(self) -> dict:
+        """Remaining messages per model over all configured tokens.
+
+        Merges the scanner snapshot, the counts other workers shared and this
+        worker's live counts, keeping the newest figure for each token and
+        model. Tokens no longer in tokens.txt are left out.
+        """
+        entries = dict(await self.executor.call(self.quota_snapshot.rows))
+        sources = {"snapshot": len(entries), "shared": 0, "live": 0}
+        if self.shared is not None:
+            try:
+                shared = await self.executor.call(self.shared.quotas)
+            except sqlite3.Error as e:
+                logging.error(f"Failed to read shared quotas: {str(e)}")
+                shared = {}
+            for key, (remaining, updated) in shared.items():
+                if key not in entries or updated >= entries[key][1]:
+                    entries[key] = (remaining, updated)
+                    sources["shared"] += 1
+        now = time.time()
+        for key, remaining in self.quota.remaining.items():
+            entries[key] = (remaining, now)
+            sources["live"] += 1
+
+        configured = {token_id(token) for token in self.POE_TOKENS}
+        models = {}
+        for (token, codename), (remaining, updated) in entries.items():
+            if token not in configured:
+                continue
+            model = models.setdefault(
+                codename, {"remaining": 0, "tokens": 0, "exhausted": 0, "unlimited": 0, "oldest": now}
+            )
+            model["tokens"] += 1
+            model["oldest"] = min(model["oldest"], updated)
+            if remaining is None:
+                model["unlimited"] += 1
+            elif remaining <= 0:
+                model["exhausted"] += 1
+            else:
+                model["remaining"] += remaining
+        for codename, model in models.items():
+            model["oldest"] = int(model["oldest"])
+            model["names"] = [name for name, target in MODEL_MAPPING.items() if target == codename]
+        return {
+            "object": "quota",
+            "created": int(now),
+            "tokens": len(configured),
+            "snapshot_generated_at": self.quota_snapshot.generated_at,
+            "sources": sources,
+            "models": dict(sorted(models.items())),
+        }
+
+    async def close(self):
+        tasks = self._tasks + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        if self.pool.slots:
+            # Close the websockets now rather than leaving Poe to time them out.
+            closing = [asyncio.ensure_future(self.retire_client(slot, timeout=0)) for slot in list(self.pool.slots)]
+            _, pending = await asyncio.wait(closing, timeout=CLIENT_CLOSE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        if self.shared is not None:
+            try:
+                await self.executor.call(self.shared.release, os.getpid())
+            except sqlite3.Error as e:
+                logging.error(f"Failed to release token leases: {str(e)}")
+        self.executor.shutdown()
+
+    def _handle_error(self, e: Exception, slot: ClientSlot, codename: str):
+        logging.error(f"Unexpected error during instruction on client {slot.id}: {str(e)}")
+        metrics.errors.inc(codename, slot.id, type(e).__name__)
+        if str(e).startswith(QUOTA_ERROR_PREFIX):
+            self.quota.mark_exhausted(slot, codename)
+            return
+        if str(e).startswith(CONNECTION_ERROR_PREFIXES):
+            backoff = slot.breaker.trip()
+            logging.warning(
+                f"Connection to client {slot.id} lost, reconnecting in the background (circuit open for {backoff:.0f}s)."
+            )
+            if not slot.reconnecting:
+                self._spawn(self.reconnect_client(slot))
+            return
+        if str(e) == "Response timed out.":
+            metrics.timeouts.inc(codename, slot.id)
+            backoff = self.quarantine.add(slot.id, "timeout")
+            logging.warning(f"Response timed out, client {slot.id} quarantined for {backoff:.0f}s. Retrying...")
+            return
+        slot.breaker.record_failure()
+
+    async def reconnect_client(self, slot: ClientSlot):
+        """Rebuild a client's connection while the other clients keep serving.
+
+        Keeps trying, with the circuit breaker's backoff between attempts,
+        until it succeeds or the slot is retired.
+        """
+        slot.reconnecting = True
+        try:
+            while slot in self.pool.slots:
+                old_client = slot.client
+                try:
+                    await self.executor.call(old_client.disconnect_ws)
+                except Exception:
+                    pass
+                try:
+                    client = await self.executor.call(_connect_client, slot.token, slot.proxy)
+                except Exception as e:
+                    backoff = slot.breaker.trip()
+                    metrics.reconnects.inc(slot.id, "failed")
+                    logging.error(f"Reconnecting client {slot.id} failed, next try in {backoff:.0f}s: {str(e)}")
+                    await asyncio.sleep(backoff)
+                    continue
+                self.executor.forget(old_client)
+                slot.client = client
+                # Let one probe request through before trusting it fully.
+                slot.breaker.open_until = 0.0
+                metrics.reconnects.inc(slot.id, "ok")
+                logging.info(f"Client {slot.id} reconnected.")
+                return
+        finally:
+            slot.reconnecting = False
+
+    async def _stream_upstream(self, messages: List[Message], codename: str, max_retries: int):
+        """Yield the assistant reply piece by piece as Poe produces it,
+        once the request has been admitted."""
+        user_indexes = [i for i, msg in enumerate(messages) if msg.role == "user"]
+        last_user_message = messages[user_indexes[-1]].content
+        if not last_user_message.strip():  # Check if the message is not empty
+            logging.warning("Attempted to send an empty message, skipping.")
+            return
+
+        conversation = messages[: user_indexes[-1] + 1]
+        prefer = None
+        if self.affinity is not None and len(conversation) > 1:
+            prefer = self.affinity.take(codename, conversation[:-1])
+
+        async with self.admission.admit(codename):
+            async for delta in self._stream_attempts(conversation, codename, max_retries, prefer):
+                yield delta
+
+    async def _stream_attempts(
+        self, conversation: List[Message], codename: str, max_retries: int, prefer: str = None
+    ):
+        """Send the conversation, retrying on other clients if needed.
+
+        If ``prefer`` names the slot whose chat already holds the earlier
+        turns, only the newest message is sent there. Anywhere else the
+        whole conversation is sent after a chat break.
+
+        Each attempt leases its own client slot; a slot that failed is not
+        tried again for the same request. Failures before the first piece
+        are retried, once text has been sent to the caller the error is
+        raised instead.
+        """
+        failed = set()
+        for attempt in range(max_retries):
+            try:
+                stream, piece = await self._first_piece(conversation, codename, failed, prefer)
+            except NoClientAvailable:
+                raise
+            except Exception:
+                stream = None  # already handled by _attempt, try another client
+            if stream is not None:
+                try:
+                    yield piece
+                    async for delta in stream:
+                        yield delta
+                finally:
+                    await stream.aclose()
+                return
+            prefer = None
+            delay = min(2.0, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            metrics.retries.inc(codename)
+            metrics.retry_sleep.inc(codename, amount=delay)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.retries += 1
+                trace.add("retry", delay)
+            await asyncio.sleep(delay)
+        raise RuntimeError("Failed after retries.")
+
+    async def _first_piece(self, conversation: List[Message], codename: str, failed: set, prefer: str = None):
+        """Start a call and wait for its first piece, hedging it if it is slow.
+
+        Returns the stream that answered first and that piece; the other
+        call, if any, is cancelled and its slot is charged the time it took
+        without answering. Slots that fail are added to ``failed``. Raises
+        the last error if every call failed.
+        """
+        racing = {}  # __anext__ future -> (slot, stream, start time)
+        streams = []
+        hedge_delay = self.hedging.delay(codename)
+        error = None
+        won = False
+
+        async def _start(idle: bool):
+            exclude = failed | {slot.id for slot, _, _ in racing.values()}
+            stream = self._attempt(conversation, codename, exclude, prefer, idle)
+            slot = await stream.__anext__()  # leases the slot, raises NoClientAvailable
+            streams.append(stream)
+            racing[asyncio.ensure_future(stream.__anext__())] = (slot, stream, time.monotonic())
+            self.hedging.record_call()
+
+        await _start(idle=False)
+        try:
+            while racing:
+                done, _ = await asyncio.wait(racing, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_delay = None  # one hedge per call at most
+                    if self.hedging.can_hedge():
+                        try:
+                            await _start(idle=True)
+                        except NoClientAvailable:
+                            continue  # no idle client to hedge on
+                        self.hedging.record_hedge()
+                        logging.info(f"Hedging a slow {codename} call on a second client.")
+                    continue
+                for future in done:
+                    slot, stream, _ = racing.pop(future)
+                    try:
+                        piece = future.result()
+                    except StopAsyncIteration:
                         continue
-                    else:
-                        logging.error("Failed after 3 retries.")
-                elif str(e) in ["Websocket closed with status None: None",
-                                 "Connection to remote host was lost. - goodbye"]:
-                    logging.warning("Restarting due to websocket error...")
-                    os.kill(os.getpid(), signal.SIGINT)
-                    break
-        self._rotate_token()  # Rotate to the next token for the next attempt
-        return {"role": "assistant", "content": "fail"}
+                    except Exception as e:
+                        failed.add(slot.id)
+                        error = e
+                        continue
+                    if len(streams) > 1:
+                        hedge_won = stream is streams[-1]
+                        self.hedging.hedge_wins += hedge_won
+                        metrics.hedges.inc(codename, "won" if hedge_won else "lost")
+                    streams.remove(stream)
+                    won = True
+                    return stream, piece
+            raise error or RuntimeError("Upstream call ended without a reply.")
+        finally:
+            now = time.monotonic()
+            for future, (slot, _, started) in racing.items():
+                future.cancel()
+                if won:
+                    # Still waiting for its first piece: the whole reply would
+                    # have taken that long on top of its usual time.
+                    slot.record_latency(now - started + (slot.latency or self.pool.mean_latency()))
+            await asyncio.gather(*racing, return_exceptions=True)
+            for stream in streams:
+                await stream.aclose()
+
+    async def _attempt(
+        self, conversation: List[Message], codename: str, exclude: set, prefer: str = None, idle: bool = False
+    ):
+        """One upstream call. Yields the leased slot first, then the reply pieces.
+
+        The slot stays leased until the generator is closed. Errors before
+        the first piece are handled here and then raised.
+        """
+        async with self.pool.lease(codename, exclude=exclude, prefer=prefer, idle=idle) as slot:
+            yield slot
+            continues_chat = slot.id == prefer
+            if continues_chat:
+                message = conversation[-1].content
+            else:
+                message = render_transcript(conversation)
+            if self.affinity is not None:
+                self.affinity.claim(slot.id, codename)
+            parts = []
+            started = False
+            returned = lingering = False
+
+            def _returned():
+                nonlocal returned
+                returned = True
+                if lingering:
+                    slot.in_flight -= 1
+
+            start = time.monotonic()
+            upstream = self.executor.stream(
+                slot.client, _stream_reply, slot.client, codename, message, not continues_chat, on_release=_returned
+            )
+            try:
+                async for delta in upstream:
+                    if not started:
+                        started = True
+                        first = time.monotonic() - start
+                        self.quota.record_send(slot, codename)
+                        self.hedging.observe(codename, first)
+                        metrics.upstream_first_chunk.observe(first, codename)
+                        trace_phase("ttft", first)
+                    parts.append(delta)
+                    yield delta
+            except Exception as e:  # Catch all other exceptions
+                trace_phase("upstream", time.monotonic() - start)
+                if not started:
+                    self._handle_error(e, slot, codename)
+                raise
+            finally:
+                await upstream.aclose()
+                if not returned:
+                    # The lease ends before the worker thread does: keep the
+                    # slot counted as busy until the thread gives it back.
+                    lingering = True
+                    slot.in_flight += 1
+            elapsed = time.monotonic() - start
+            trace_phase("upstream", elapsed)
+            slot.record_latency(elapsed)
+            slot.breaker.record_success()
+            self.quarantine.record_success(slot.id, codename)
+            metrics.upstream_duration.observe(elapsed, slot.id, proxy_label(slot.proxy))
+            parts.append("\n---\n")  # add a chat break at the end of the message
+            if self.affinity is not None:
+                turns = [(msg.role, msg.content) for msg in conversation]
+                self.affinity.record(slot.id, codename, turns + [("assistant", "".join(parts))])
+            yield parts[-1]
+
+    async def _generate(self, messages: List[Message], codename: str, max_retries: int) -> str:
+        return "".join([part async for part in self._stream_upstream(messages, codename, max_retries)])
+
+    async def instruct_stream(self, messages: List[Message], model: str = None, max_retries=3, use_cache=True):
+        """Yield the assistant reply piece by piece.
+
+        With the response cache enabled, a cached or already in-flight answer
+        is sent as a single piece; otherwise the live stream is forwarded and
+        stored once it completes.
+        """
+        codename = resolve_model(model) if model else self.AI_MODEL
+        messages, codename = fit_context(messages, codename)
+        if self.cache is None or not use_cache:
+            async for delta in self._stream_upstream(messages, codename, max_retries):
+                yield delta
+            return
+
+        key = ResponseCache.key(codename, messages)
+        cached = self.cache.get(key)
+        if cached is None and self.cache.pending(key):
+            cached = await self.cache.get_or_compute(
+                key, lambda: self._generate(messages, codename, max_retries)
+            )
+        if cached is not None:
+            yield cached
+            return
+
+        self.cache.begin(key)
+        parts = []
+        try:
+            async for delta in self._stream_upstream(messages, codename, max_retries):
+                parts.append(delta)
+                yield delta
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cache.abort(key, _LeaderCancelled())
+            raise
+        except Exception as e:
+            self.cache.abort(key, e)
+            raise
+        self.cache.finish(key, "".join(parts))
+
+    async def complete(self, messages: List[Message], model: str = None, max_retries=3, use_cache=True) -> str:
+        """Return the whole reply, raising if every attempt failed."""
+        codename = resolve_model(model) if model else self.AI_MODEL
+        messages, codename = fit_context(messages, codename)
+        if self.cache is not None and use_cache:
+            return await self.cache.get_or_compute(
+                ResponseCache.key(codename, messages),
+                lambda: self._generate(messages, codename, max_retries),
+            )
+        return await self._generate(messages, codename, max_retries)
+
+    async def instruct(self, messages: List[Message], model: str = None, tokens: int = 0, max_retries=3, use_cache=True):
+        try:
+            content = await self.complete(messages, model, max_retries, use_cache)
+        except (Overloaded, ContextTooLarge):
+            raise
+        except Exception as e:
+            logging.error(f"Failed after {max_retries} retries: {str(e)}")
+            return {"role": "assistant", "content": "fail"}
+        return {"role": "assistant", "content": content}
 
 
 def load_tokens_from_file(file_path: str) -> List[str]:
@@ -221,9 +2719,73 @@ def load_proxies_from_file(file_path: str) -> List[str]:
     return proxies
 
 
-def save_tokens_to_file(file_path: str, tokens: List[str]):
+def _file_signatures(paths) -> tuple:
+    """Modification time and size of each file, or None if it is missing."""
+    signatures = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signatures.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signatures.append(None)
+    return tuple(signatures)
+
+
+def quarantine_path(tokens_file: str) -> str:
+    """The quarantine is kept next to the tokens file: tokens.txt -> tokens.quarantine.json."""
+    return os.path.splitext(tokens_file)[0] + ".quarantine.json"
+
+
+def load_quarantine_from_file(file_path: str) -> list:
+    try:
+        with open(file_path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring unreadable token quarantine {file_path}: {str(e)}")
+        return []
+
+
+def save_quarantine_to_file(file_path: str, rows: list, lifted: list = ()):
+    """Save quarantine rows, keeping unexpired rows saved by other workers.
+
+    ``lifted`` are entries this worker released early; their saved rows are
+    dropped so the next start does not quarantine the token again. Rows with
+    a different release time were written by another quarantine and stay.
+    Workers take a lock file around the read-merge-replace, so none of them
+    overwrites rows another one saved in between.
+    """
+    dropped = {(row["token"], row.get("codename"), row["until"]) for row in lifted}
+    with open(f"{file_path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        now = time.time()
+        saved = [
+            row
+            for row in load_quarantine_from_file(file_path)
+            if (row["token"], row.get("codename"), row["until"]) not in dropped
+        ]
+        merged = {}
+        for row in saved + rows:
+            key = (row["token"], row.get("codename"))
+            if row["until"] > now and (key not in merged or row["until"] > merged[key]["until"]):
+                merged[key] = row
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(list(merged.values()), file, indent=2)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            raise
+
+
+def save_tokens_to_file(file_path: str, tokens: List[str], quarantine: TokenQuarantine = None):
     with open(file_path, "w") as file:
         file.write("\n".join(tokens))
+    if quarantine is not None:
+        save_quarantine_to_file(quarantine_path(file_path), quarantine.rows(), quarantine.lifted_rows())
 
 
 def save_proxies_to_file(file_path: str, proxies: List[str]):
@@ -232,6 +2794,7 @@ def save_proxies_to_file(file_path: str, proxies: List[str]):
 
 
 poe_provider = None
+rate_limiter = None
 
 
 def generate_id():
@@ -246,145 +2809,972 @@ def generate_id():
 
 @app.on_event("startup")
 async def startup_event():
-    global poe_provider
+    global poe_provider, rate_limiter
     # Load the POE_TOKENS from a file called "tokens.txt"
-    POE_TOKENS_FILE = "tokens.txt"
-    POE_TOKENS = load_tokens_from_file(POE_TOKENS_FILE)
+    POE_TOKENS = load_tokens_from_file(TOKENS_FILE)
 
     # Load the PROXIES from a file called "proxies.txt"
-    PROXY_LIST_FILE = "proxies.txt"
-    PROXIES = load_proxies_from_file(PROXY_LIST_FILE)
+    PROXIES = load_proxies_from_file(PROXIES_FILE)
 
     poe_provider = PoeProvider(
         POE_TOKENS=POE_TOKENS,
         PROXIES=PROXIES,
         AI_MODEL="vizcacha",
+        shared=SharedState(STATE_DB) if WORKER_COORDINATION == "sqlite" else None,
     )
+    # Keep tokens that failed before the restart out until their time is up.
+    poe_provider.quarantine.load(load_quarantine_from_file(quarantine_path(TOKENS_FILE)))
+    rate_limiter = RateLimiter(RATE_LIMITS, shared=poe_provider.shared)
+    await poe_provider.claim_tokens()
+    poe_provider.start(tokens_file=TOKENS_FILE, proxies_file=PROXIES_FILE)
+    rate_limiter.start(poe_provider.executor)
+    drain.install_signal_handlers()
+    await poe_provider.connect()
+
+
+def _completion_response(model: str, content: str) -> dict:
+    return {
+        "id": generate_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": content,
+                },
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+class BatchJob:
+    """A list of chat requests worked through in the background.
+
+    Results are kept in completion order, so a reader that lost its
+    connection can pick up again from the number of lines it already has.
+    """
+
+    def __init__(self, items: list, concurrency: int):
+        self.id = "batch_" + "".join(random.choice(string.ascii_letters + string.digits) for _ in range(24))
+        self.items = items
+        self.concurrency = concurrency
+        self.results = []
+        self.failed = 0
+        self.status = "running"
+        self.created = int(time.time())
+        self.finished_at = None
+        self._changed = asyncio.Condition()
+        self.task = None
+
+    async def _publish(self, result: dict):
+        async with self._changed:
+            self.results.append(result)
+            if result["error"] is not None:
+                self.failed += 1
+            self._changed.notify_all()
+
+    async def _run_item(self, provider, index: int, item):
+        custom_id = item.get("custom_id") if isinstance(item, dict) else None
+        result = {"index": index, "custom_id": custom_id, "response": None, "error": None}
+        try:
+            body = item.get("body", item) if isinstance(item, dict) else item
+            request = Messages(**body)
+            deadline = time.monotonic() + BATCH_ITEM_MAX_WAIT
+            while True:
+                try:
+                    content = await provider.complete(request.messages, request.model, use_cache=request.cache)
+                    break
+                except Overloaded as e:
+                    # Batches are not in a hurry: wait for room instead of failing,
+                    # but not forever (a worker without clients never has room).
+                    if time.monotonic() + e.retry_after > deadline:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+            result["response"] = _completion_response(request.model, content)
+        except Exception as e:
+            result["error"] = {"message": str(e), "type": type(e).__name__}
+        await self._publish(result)
+
+    async def run(self, provider):
+        current_trace.set(None)  # items are not part of the request that submitted the batch
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def _limited(index, item):
+            async with limit:
+                await self._run_item(provider, index, item)
+
+        try:
+            await asyncio.gather(*(_limited(i, item) for i, item in enumerate(self.items)))
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        finally:
+            self.finished_at = time.monotonic()
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def follow(self, after: int = 0):
+        """Yield results from position ``after`` on, waiting for new ones
+        until the batch is finished."""
+        position = after
+        while True:
+            async with self._changed:
+                while position >= len(self.results) and self.status == "running":
+                    await self._changed.wait()
+                pending = self.results[position:]
+                done = self.status != "running"
+            for result in pending:
+                yield result
+            position += len(pending)
+            if done and position >= len(self.results):
+                return
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "status": self.status,
+            "created": self.created,
+            "total": len(self.items),
+            "completed": len(self.results),
+            "failed": self.failed,
+            "concurrency": self.concurrency,
+        }
 
 
-async def stream_response(data):
-    if isinstance(data, dict):
-        first_chunk = True
-        words = data["choices"][0]["message"]["content"].split()
-        for i in range(len(words)):
-            word = words[i] + " " if i != len(words) - 1 else words[i]
-            chunk = {
-                "id": data["id"],
-                "object": data["object"],
-                "created": data["created"],
-                "model": data["model"],
-                "choices": [
-                    {
-                        "index": data["choices"][0]["index"],
-                        "delta": {"role": "assistant", "content": word}
-                        if first_chunk
-                        else {"content": word},
-                        "finish_reason": None,
-                    }
-                ],
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
-            if first_chunk:
-                first_chunk = False
-
-        # Add a final chunk to signify completion
-        done_chunk = {
-            "id": data["id"],
-            "object": data["object"],
-            "created": data["created"],
-            "model": data["model"],
-            "choices": [
-                {
-                    "index": data["choices"][0]["index"],
-                    "delta": {},
-                    "finish_reason": "stop",
-                }
-            ],
+class BatchRegistry:
+    """Running and recently finished batches of this worker."""
+
+    def __init__(self, ttl: float = BATCH_TTL):
+        self.ttl = ttl
+        self.jobs = {}
+
+    def _evict(self):
+        now = time.monotonic()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at + self.ttl < now:
+                del self.jobs[job_id]
+
+    def submit(self, provider, items: list, concurrency: int) -> BatchJob:
+        self._evict()
+        job = BatchJob(items, concurrency)
+        job.task = asyncio.create_task(job.run(provider))
+        self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        self._evict()
+        return self.jobs.get(job_id)
+
+    def running(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status == "running")
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+batches = BatchRegistry()
+
+
+# Graceful drain. SIGTERM, SIGUSR1 or POST /admin/drain make the worker
+# refuse new work and report not ready, while running requests get up to
+# DRAIN_TIMEOUT seconds to finish before it shuts down.
+DRAIN_TIMEOUT = float(os.getenv("POE_DRAIN_TIMEOUT", "30"))
+DRAIN_RETRY_AFTER = 5
+# Bearer key for the /admin endpoints; they are disabled while it is empty.
+ADMIN_KEY = os.getenv("POE_ADMIN_KEY", "")
+# Paths that are neither counted nor refused while draining.
+DRAIN_EXEMPT_PATHS = ("/ready", "/metrics", "/v1/status", "/v1/quota", "/admin/")
+
+
+class DrainState:
+    """Counts in-flight requests and takes this worker out of service.
+
+    Draining only refuses new work. With an exit signal it also waits for
+    the requests and batches still running, up to the deadline, then hands
+    SIGTERM back to the server so the usual shutdown hooks close the clients.
+    """
+
+    def __init__(self, timeout: float = DRAIN_TIMEOUT):
+        self.timeout = timeout
+        self.in_flight = 0
+        self.rejected = 0
+        self.draining = False
+        self.started_at = None
+        self.task = None
+        self._previous = {}
+
+    def busy(self) -> int:
+        return self.in_flight + batches.running()
+
+    def begin(self, exit_signal: int = None):
+        """Stop taking new work; with ``exit_signal``, shut down once drained."""
+        if not self.draining:
+            self.draining = True
+            self.started_at = time.monotonic()
+            logging.warning(f"Draining: {self.in_flight} requests in flight, new work is refused.")
+        if exit_signal is not None and self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._drain_and_exit())
+
+    def resume(self) -> bool:
+        """Take work again, unless the worker is already shutting down."""
+        if self.task is not None:
+            return False
+        if self.draining:
+            logging.warning("Drain cancelled, taking new work again.")
+        self.draining = False
+        self.started_at = None
+        return True
+
+    async def wait(self) -> bool:
+        """Wait until nothing is running; False if the deadline passed first."""
+        deadline = self.started_at + self.timeout
+        while self.busy():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+    async def _drain_and_exit(self):
+        if await self.wait():
+            logging.warning(f"Drained in {time.monotonic() - self.started_at:.1f}s, shutting down.")
+        else:
+            logging.warning(f"Drain deadline passed with {self.busy()} requests still running, shutting down.")
+        self._exit()
+
+    def _exit(self):
+        # Give SIGTERM back to the server (uvicorn) and raise it, so it stops
+        # listening and runs the shutdown hooks as on any other stop.
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, self._previous.get(signal.SIGTERM, signal.SIG_DFL))
+        signal.raise_signal(signal.SIGTERM)
+
+    def _on_signal(self, signum: int):
+        if self.task is not None and not self.task.done():
+            logging.warning("Signal received while draining, shutting down now.")
+            self.task.cancel()
+            self._exit()
+            return
+        self.begin(exit_signal=signum)
+
+    def install_signal_handlers(self):
+        loop = asyncio.get_running_loop()
+        for name in ("SIGTERM", "SIGUSR1"):
+            signum = getattr(signal, name, None)
+            if signum is None:
+                continue  # not on this platform
+            previous = signal.getsignal(signum)
+            try:
+                loop.add_signal_handler(signum, self._on_signal, signum)
+            except (ValueError, RuntimeError, NotImplementedError):
+                continue  # not the main thread, or no signal support in this loop
+            self._previous[signum] = previous
+
+    def stats(self) -> dict:
+        return {
+            "draining": self.draining,
+            "exiting": self.task is not None,
+            "seconds": round(time.monotonic() - self.started_at, 1) if self.started_at is not None else None,
+            "deadline": self.timeout,
+            "in_flight": self.in_flight,
+            "batches_running": batches.running(),
+            "rejected": self.rejected,
         }
-        yield f"data: {json.dumps(done_chunk)}\n\n"
-        yield "data: [DONE]\n\n"  # Signal the end of the stream
+
+
+drain = DrainState()
+
+
+class DrainMiddleware:
+    """Counts requests in flight and refuses new work while draining.
+
+    Only POSTs are refused, so clients can still poll and resume the
+    results of batches that keep running on this worker.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(DRAIN_EXEMPT_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        if drain.draining and scope["method"] == "POST":
+            drain.rejected += 1
+            response = JSONResponse(
+                {"detail": "Server is draining, retry on another instance."},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(DRAIN_RETRY_AFTER), "Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+
+        drain.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            drain.in_flight -= 1
+
+
+app.add_middleware(DrainMiddleware)
+
+
+def _parse_batch_body(raw: bytes):
+    """Accept a JSON list, {"requests": [...], "concurrency": n} or JSONL.
+
+    Any other JSON object is a single chat request, which is also what a
+    one-line JSONL body parses to.
+    """
+    text = raw.decode("utf-8")
+    try:
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        payload = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(payload, dict):
+        if "requests" not in payload:
+            return [payload], None
+        return payload["requests"] or [], payload.get("concurrency")
+    if isinstance(payload, list):
+        return payload, None
+    raise ValueError("Expected a list of chat requests.")
+
+
+def _batch_costs(items: list) -> dict:
+    """Upstream messages a batch will send, per model."""
+    costs = {}
+    for item in items:
+        body = item.get("body", item) if isinstance(item, dict) else None
+        if isinstance(body, dict) and isinstance(body.get("model"), str):
+            codename = resolve_model(body["model"])
+            costs[codename] = costs.get(codename, 0) + 1
+    return costs
+
+
+async def _batch_lines(job: BatchJob, after: int = 0, header: bool = False):
+    if header:
+        yield json.dumps(job.stats()) + "\n"
+    async for result in job.follow(after):
+        yield json.dumps(result) + "\n"
+
+
+def _json_dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+class SSEEncoder:
+    """Encodes one response's ``chat.completion.chunk`` events.
+
+    Everything but the delta text is the same for every event of a
+    response, so the envelope is serialized once and only the text is
+    escaped and spliced in.
+    """
+
+    _MARK = "\x00content\x00"
+
+    def __init__(self, response_id: str, model: str, created: int = None):
+        self.response_id = response_id
+        self.model = model
+        self.created = created or int(time.time())
+        self._first = self._split({"role": "assistant", "content": self._MARK})
+        self._next = self._split({"content": self._MARK})
+
+    def _envelope(self, delta: dict, finish_reason=None) -> dict:
+        return {
+            "id": self.response_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def _split(self, delta: dict):
+        before, after = _json_dumps(self._envelope(delta)).split(_json_dumps(self._MARK))
+        return "data: " + before, after + "\n\n"
+
+    def delta(self, text: str, first: bool = False) -> str:
+        prefix, suffix = self._first if first else self._next
+        return prefix + _json_dumps(text) + suffix
+
+    def error(self, message: str) -> str:
+        return f"data: {_json_dumps({'error': {'message': message, 'type': 'upstream_error'}})}\n\n"
+
+    def done(self, complete: bool = True) -> str:
+        # A final chunk to signify completion, then the end of the stream.
+        # A reply cut short by an error must not look complete, so it only
+        # gets the end marker.
+        if not complete:
+            return "data: [DONE]\n\n"
+        return f"data: {_json_dumps(self._envelope({}, 'stop'))}\n\ndata: [DONE]\n\n"
+
+
+async def paced_deltas(
+    deltas,
+    first: asyncio.Future = None,
+    max_bytes: int = SSE_COALESCE_BYTES,
+    max_delay: float = SSE_COALESCE_MS / 1000,
+    keepalive: float = SSE_KEEPALIVE,
+):
+    """Merge small reply pieces and mark idle periods.
+
+    Yields text to send, or None when nothing arrived for ``keepalive``
+    seconds. The first piece is passed on at once; later ones are held until
+    ``max_bytes`` are buffered or ``max_delay`` has passed. ``first`` may be
+    an already started ``__anext__`` of ``deltas``.
+    """
+    iterator = deltas.__aiter__()
+    pending = first
+    buffer = []
+    size = 0
+    flush_at = None
+    sent_any = False
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = keepalive if flush_at is None else max(0.0, flush_at - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, size, flush_at = [], 0, None
+                else:
+                    yield None
+                continue
+            future, pending = pending, None
+            try:
+                piece = future.result()
+            except StopAsyncIteration:
+                if buffer:
+                    yield "".join(buffer)
+                return
+            buffer.append(piece)
+            size += len(piece)
+            if not sent_any or size >= max_bytes:
+                sent_any = True
+                yield "".join(buffer)
+                buffer, size, flush_at = [], 0, None
+            elif flush_at is None:
+                flush_at = time.monotonic() + max_delay
+    finally:
+        if pending is not None:
+            # Wait for the cancelled read to unwind, so ``deltas`` is no
+            # longer running when the caller closes it.
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+
+
+async def wait_first_piece(first: asyncio.Future, admitted: asyncio.Event, timeout: float):
+    """Wait for ``first`` until ``timeout`` seconds after the request was admitted.
+
+    The time spent in the request queue does not count, so a request the
+    queue turns away still gets a 429 instead of an error event. Requests
+    that are never admitted themselves (waiting on an identical request
+    through the cache) wait no longer than a queued request could.
+    """
+    deadline = time.monotonic() + QUEUE_MAX_WAIT + timeout
+    admission = asyncio.ensure_future(admitted.wait())
+    try:
+        await asyncio.wait({first, admission}, timeout=QUEUE_MAX_WAIT + timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not first.done():
+            await asyncio.wait({first}, timeout=max(0.0, min(timeout, deadline - time.monotonic())))
+    finally:
+        admission.cancel()
+
+
+async def stream_response(encoder: SSEEncoder, deltas, first: asyncio.Future = None, started: float = None):
+    """Forward reply pieces as OpenAI ``chat.completion.chunk`` events."""
+    outcome = "ok"
+    sent_any = False
+    trace = current_trace.get()
+    encoding = 0.0
+    try:
+        async for text in paced_deltas(deltas, first):
+            if text is None:
+                yield ": keep-alive\n\n"
+                continue
+            if not sent_any and started is not None:
+                metrics.time_to_first_token.observe(time.monotonic() - started, resolve_model(encoder.model))
+            start = time.monotonic()
+            event = encoder.delta(text, first=not sent_any)
+            encoding += time.monotonic() - start
+            yield event
+            sent_any = True
+        if not sent_any:
+            yield encoder.delta("", first=True)
+    except Exception as e:
+        outcome = "error"
+        logging.error(f"Upstream error while streaming: {str(e)}")
+        yield encoder.error(str(e))
+    except BaseException:
+        outcome = "disconnected"
+        raise
+    finally:
+        await deltas.aclose()
+        if trace is not None:
+            trace.add("serialize", encoding)
+        if started is not None:
+            _record_request(encoder.model, started, outcome, stream=True)
+
+    yield encoder.done(complete=outcome == "ok")
+
+
+class CompletionEncoder:
+    """Encodes legacy ``text_completion`` responses and stream chunks."""
+
+    def __init__(self, response_id: str, model: str, created: int = None):
+        self.response_id = response_id
+        self.model = model
+        self.created = created or int(time.time())
+
+    def _envelope(self, choices: list) -> dict:
+        return {
+            "id": self.response_id,
+            "object": "text_completion",
+            "created": self.created,
+            "model": self.model,
+            "choices": choices,
+        }
+
+    def response(self, texts: List[str]) -> dict:
+        return self._envelope(
+            [
+                {"text": text, "index": index, "logprobs": None, "finish_reason": "stop"}
+                for index, text in enumerate(texts)
+            ]
+        )
+
+    def chunk(self, index: int, text: str, finish_reason: str = None) -> str:
+        choice = {"text": text, "index": index, "logprobs": None, "finish_reason": finish_reason}
+        return f"data: {_json_dumps(self._envelope([choice]))}\n\n"
+
+    def error(self, index: int, message: str) -> str:
+        return f"data: {_json_dumps({'error': {'message': message, 'type': 'upstream_error', 'index': index}})}\n\n"
+
+
+class CompletionFanout:
+    """Runs several reply streams at once and merges their pieces.
+
+    Each stream is read by its own task into one queue of ``(index, text,
+    error)`` items; ``text`` None marks the end of that stream.
+    """
+
+    def __init__(self, streams: list):
+        self.queue = asyncio.Queue()
+        self.remaining = len(streams)
+        self.admitted = asyncio.Event()  # set once any choice leaves the request queue
+        notice = admission_notice.set(self.admitted)
+        self.tasks = [asyncio.create_task(self._pump(index, stream)) for index, stream in enumerate(streams)]
+        admission_notice.reset(notice)
+
+    async def _pump(self, index: int, stream):
+        paced = paced_deltas(stream)
+        try:
+            async for text in paced:
+                if text is not None:
+                    self.queue.put_nowait((index, text, None))
+            self.queue.put_nowait((index, None, None))
+        except Exception as e:
+            self.queue.put_nowait((index, None, e))
+        finally:
+            await paced.aclose()
+            await stream.aclose()
+
+    async def first(self, timeout: float) -> list:
+        """Wait for the first piece of text until ``timeout`` seconds after admission.
+
+        Returns the items taken from the queue meanwhile, for ``items`` to
+        replay. Raises if one is Overloaded or ContextTooLarge, or if every
+        stream ended in an error before any text, so those still become
+        HTTP errors.
+        """
+        early = []
+        ended = failed = 0
+        error = None
+        deadline = None
+        while ended < self.remaining:
+            getter = asyncio.ensure_future(self.queue.get())
+            if deadline is None:
+                await wait_first_piece(getter, self.admitted, timeout)
+                deadline = time.monotonic() + timeout
+            else:
+                await asyncio.wait({getter}, timeout=max(0.0, deadline - time.monotonic()))
+            if not getter.done():
+                getter.cancel()
+                await asyncio.gather(getter, return_exceptions=True)
+                break
+            item = getter.result()
+            early.append(item)
+            if item[1] is not None:
+                return early
+            ended += 1
+            if isinstance(item[2], (Overloaded, ContextTooLarge)):
+                await self.close()
+                raise item[2]
+            if item[2] is not None:
+                failed += 1
+                error = item[2]
+        if failed and failed == self.remaining:
+            await self.close()
+            raise error
+        return early
+
+    async def items(self, early=(), keepalive: float = SSE_KEEPALIVE):
+        """Yield items until every stream has ended, None after ``keepalive`` idle seconds.
+
+        ``early`` are items already taken from the queue by ``first``.
+        """
+        early = deque(early)
+        while self.remaining:
+            if early:
+                item = early.popleft()
+            else:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+            if item[1] is None:
+                self.remaining -= 1
+            yield item
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for result in await asyncio.gather(*self.tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error(f"Error while closing a completion stream: {str(result)}")
+
+
+async def stream_completions(encoder: CompletionEncoder, merged: CompletionFanout, early=(), started: float = None):
+    """Forward the merged pieces of every choice as ``text_completion`` chunks."""
+    outcome = "ok"
+    sent_any = False
+    try:
+        async for item in merged.items(early):
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            index, text, error = item
+            if error is not None:
+                logging.error(f"Upstream error while streaming choice {index}: {str(error)}")
+                yield encoder.error(index, str(error))
+            elif text is None:
+                yield encoder.chunk(index, "", "stop")
+            else:
+                if not sent_any and started is not None:
+                    metrics.time_to_first_token.observe(time.monotonic() - started, resolve_model(encoder.model))
+                sent_any = True
+                yield encoder.chunk(index, text)
+    except BaseException:
+        outcome = "disconnected"
+        raise
+    finally:
+        await merged.close()
+        if started is not None:
+            _record_request(encoder.model, started, outcome, stream=True)
+
+    yield "data: [DONE]\n\n"
+
+
+async def _gather_or_cancel(awaitables):
+    """Like asyncio.gather, but cancels the rest as soon as one fails."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _use_cache(request: Request, requested: Optional[bool]) -> bool:
+    """Honour ``"cache": false`` in the body and ``Cache-Control: no-cache``."""
+    cache_control = request.headers.get("cache-control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return False
+    return requested is not False
+
+
+def _record_request(model: str, started: float, outcome: str, stream: bool = False):
+    codename = resolve_model(model)
+    metrics.request_duration.observe(time.monotonic() - started, codename, "true" if stream else "false")
+    metrics.requests.inc(codename, outcome)
+
+
+def _http_error(e: Exception, model: str, started: float) -> HTTPException:
+    """Record a failed request and return the HTTP error to answer it with."""
+    if isinstance(e, Overloaded):
+        _record_request(model, started, "rate_limited" if isinstance(e, RateLimited) else "overloaded")
+        logging.warning(f"Rejected request: {str(e)}")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after), **getattr(e, "headers", {})},
+        )
+    if isinstance(e, ContextTooLarge):
+        _record_request(model, started, "too_large")
+        return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if isinstance(e, HTTPException):
+        _record_request(model, started, "disconnected" if e.status_code == 499 else "error")
+        logging.error(f"Error during response generation: {str(e)}")
+        return e
+    _record_request(model, started, "error")
+    logging.error(f"Unhandled exception: {str(e)}")
+    return HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/v1/chat/completions", status_code=status.HTTP_200_OK)
 async def generate_chat_response(request: Request):
+    started = time.monotonic()
+    trace = current_trace.get()
+    model = "unknown"
     try:
-        # Parse the incoming stream as JSON
-        messages = await request.json()
+        with trace.phase("parse"):
+            # Parse the incoming stream as JSON
+            messages = await request.json()
 
-        # Validate the input data
-        messages = Messages(**messages)
+            # Validate the input data
+            messages = Messages(**messages)
+        model = messages.model
+        limit_headers = rate_limiter.acquire(caller_key(request), {resolve_model(model): 1})
 
-        # Set the model in the provider
-        poe_provider.set_model(messages.model)
+        use_cache = _use_cache(request, messages.cache)
+
+        # Stream the reply as it arrives if streaming is enabled
+        if messages.stream:
+            deltas = poe_provider.instruct_stream(
+                messages=messages.messages, model=messages.model, use_cache=use_cache
+            )
+            # Give the first piece a moment so early failures (an overloaded
+            # queue, no usable client) still come back as HTTP errors.
+            admitted = asyncio.Event()
+            notice = admission_notice.set(admitted)
+            first = asyncio.ensure_future(deltas.__anext__())
+            admission_notice.reset(notice)
+            try:
+                await cancel_on_disconnect(request, wait_first_piece(first, admitted, SSE_FIRST_PIECE_WAIT))
+            except BaseException:
+                first.cancel()
+                raise
+            if first.done() and not isinstance(first.exception(), (type(None), StopAsyncIteration)):
+                raise first.exception()
+            return StreamingResponse(
+                stream_response(SSEEncoder(generate_id(), messages.model), deltas, first, started),
+                media_type="text/event-stream",
+                headers=limit_headers,
+            )
 
         # Generate the response
-        response_message = await poe_provider.instruct(messages=messages.messages)
-
-        response_data = {
-            "id": generate_id(),
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": messages.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response_message["content"],
-                    },
-                    "finish_reason": "stop",
-                }
-            ],
-        }
+        response_message = await cancel_on_disconnect(
+            request,
+            poe_provider.instruct(messages=messages.messages, model=messages.model, use_cache=use_cache),
+        )
+        _record_request(model, started, "failed" if response_message["content"] == "fail" else "ok")
 
-        # Use the stream_response function to send the data in chunks if streaming is enabled
-        if messages.stream:
-            response_data["object"] = "chat.completion.chunk"
-            if isinstance(response_data, dict):
-                return StreamingResponse(
-                    stream_response(response_data), media_type="text/event-stream"
-                )
-            else:
-                raise HTTPException(
-                    status_code=500, detail="Data format is not correct for streaming."
-                )
-        else:
-            return response_data
+        with trace.phase("serialize"):
+            body = _json_dumps(_completion_response(messages.model, response_message["content"]))
+        return Response(content=body, media_type="application/json", headers=limit_headers)
 
-    except HTTPException as e:
-        logging.error(f"Error during response generation: {str(e)}")
-        raise e
     except Exception as e:
-        logging.error(f"Unhandled exception: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _http_error(e, model, started)
 
 
-@app.post(
-    "/v1/engines/{model}/completions",
-    status_code=status.HTTP_200_OK,
-    response_class=StreamingResponse,
-)
+@app.post("/v1/engines/{model}/completions", status_code=status.HTTP_200_OK)
 async def generate_completion(request: Request, model: str, payload: CompletionPayload):
-    messages = [Message(role="user", content=payload.prompt)]
+    """Legacy completions: one or more prompts, ``n`` answers each.
+
+    All choices run at once over the client pool; choice ``i * n + j`` is
+    answer ``j`` to prompt ``i``. With ``stream`` the pieces of all choices
+    are interleaved as ``text_completion`` chunks.
+    """
+    started = time.monotonic()
+    prompts = [payload.prompt] if isinstance(payload.prompt, str) else payload.prompt
+    codename = resolve_model(model)
     try:
-        # Set the model in the provider
-        poe_provider.set_model(model)
-
-        response_message = await poe_provider.instruct(messages=messages)
+        if not prompts or payload.n < 1 or len(prompts) * payload.n > COMPLETION_MAX_CHOICES:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Between 1 and {COMPLETION_MAX_CHOICES} choices (prompts times n) can be requested.",
+            )
+        conversations = [[Message(role="user", content=prompt)] for prompt in prompts for _ in range(payload.n)]
+        for prompt in prompts:
+            fit_context([Message(role="user", content=prompt)], codename)  # fail fast with a 400
+        limit_headers = rate_limiter.acquire(caller_key(request), {codename: len(conversations)})
+        # n > 1 asks for different answers, which the cache would make identical.
+        use_cache = _use_cache(request, None) and payload.n == 1
+        encoder = CompletionEncoder(generate_id(), model)
+
+        if payload.stream:
+            merged = CompletionFanout(
+                [
+                    poe_provider.instruct_stream(messages=messages, model=model, use_cache=use_cache)
+                    for messages in conversations
+                ]
+            )
+            try:
+                early = await cancel_on_disconnect(request, merged.first(SSE_FIRST_PIECE_WAIT))
+            except BaseException:
+                await merged.close()
+                raise
+            return StreamingResponse(
+                stream_completions(encoder, merged, early, started),
+                media_type="text/event-stream",
+                headers=limit_headers,
+            )
 
-        return {
-            "id": generate_id(),
-            "object": "text.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [{"text": response_message["content"], "index": 0}],
-        }
-    except HTTPException as e:
-        logging.error(f"Error during response generation: {str(e)}")
-        raise e
+        replies = await cancel_on_disconnect(
+            request,
+            _gather_or_cancel(
+                poe_provider.instruct(messages=messages, model=model, use_cache=use_cache)
+                for messages in conversations
+            ),
+        )
+        failed = sum(1 for reply in replies if reply["content"] == "fail")
+        _record_request(model, started, "failed" if failed == len(replies) else "ok")
+        return Response(
+            content=_json_dumps(encoder.response([reply["content"] for reply in replies])),
+            media_type="application/json",
+            headers=limit_headers,
+        )
     except Exception as e:
-        logging.error(f"Unhandled exception: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _http_error(e, model, started)
+
+
+@app.post("/v1/batch/chat/completions", status_code=status.HTTP_200_OK)
+async def create_batch(request: Request):
+    """Run many chat requests and stream the results back as JSONL.
+
+    The first line describes the batch; every further line is one result,
+    in completion order. The batch keeps running if the connection drops;
+    resume from GET /v1/batch/{batch_id}/results?after=<lines received>.
+    """
+    try:
+        items, concurrency = _parse_batch_body(await request.body())
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch: {str(e)}")
+    if not items:
+        raise HTTPException(status_code=400, detail="Invalid batch: no requests given.")
+    concurrency = max(1, min(int(concurrency or BATCH_CONCURRENCY), BATCH_MAX_CONCURRENCY))
+    try:
+        limit_headers = rate_limiter.acquire(caller_key(request), _batch_costs(items))
+    except RateLimited as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e), headers=e.headers)
+    job = batches.submit(poe_provider, items, concurrency)
+    logging.info(f"Started batch {job.id} with {len(items)} requests.")
+    return StreamingResponse(
+        _batch_lines(job, header=True),
+        media_type="application/x-ndjson",
+        headers={"X-Batch-Id": job.id, **limit_headers},
+    )
+
+
+@app.get("/v1/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    job = batches.get(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found.")
+    return job.stats()
+
+
+@app.get("/v1/batch/{batch_id}/results")
+async def get_batch_results(batch_id: str, after: int = 0):
+    job = batches.get(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found.")
+    return StreamingResponse(_batch_lines(job, after), media_type="application/x-ndjson")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.render(poe_provider), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/v1/quota")
+async def get_quota():
+    return await poe_provider.quota_report()
+
+
+@app.get("/v1/status")
+async def get_status():
+    return {
+        "executor": poe_provider.executor.stats(),
+        "clients": poe_provider.pool.stats(),
+        "connecting": len(poe_provider.connecting),
+        "quota": poe_provider.quota.stats(),
+        "quarantine": poe_provider.quarantine.stats(),
+        "admission": poe_provider.admission.stats(),
+        "worker": {
+            "pid": os.getpid(),
+            "tokens_held": len(poe_provider.owned) if poe_provider.owned is not None else len(poe_provider.POE_TOKENS),
+        },
+        "cache": poe_provider.cache.stats() if poe_provider.cache is not None else None,
+        "affinity": poe_provider.affinity.stats() if poe_provider.affinity is not None else None,
+        "hedging": poe_provider.hedging.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "drain": drain.stats(),
+    }
+
+
+@app.get("/ready")
+async def get_ready():
+    """Readiness for load balancers: 503 while draining or without clients."""
+    clients = len(poe_provider.pool) if poe_provider is not None else 0
+    ready = clients > 0 and not drain.draining
+    return JSONResponse(
+        {"ready": ready, "draining": drain.draining, "clients": clients, "in_flight": drain.in_flight},
+        status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+def _check_admin(request: Request):
+    if not ADMIN_KEY:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    supplied = request.headers.get("authorization", "").encode()
+    if not hmac.compare_digest(supplied, f"Bearer {ADMIN_KEY}".encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin key.")
+
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request, exit: bool = False):
+    """Stop taking new work; with ``exit=true`` the worker also shuts down once drained."""
+    _check_admin(request)
+    drain.begin(exit_signal=signal.SIGTERM if exit else None)
+    return drain.stats()
+
+
+@app.post("/admin/resume")
+async def admin_resume(request: Request):
+    _check_admin(request)
+    if not drain.resume():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The worker is already shutting down.")
+    return drain.stats()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Without a drain first (e.g. Ctrl+C), still let running batches finish.
+    drain.begin()
+    await drain.wait()
+    await batches.close()
+    if rate_limiter is not None:
+        await rate_limiter.close()
+    if poe_provider is not None:
+        await poe_provider.close()
+    _log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+"""Shared setup: the server runs on the fake backend, see fake_poe.py."""
+import contextlib
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+os.environ.setdefault("POE_FAKE_BACKEND", "1")
+os.environ.setdefault("FAKE_POE_CONNECT_DELAY", "0")
+os.environ.setdefault("FAKE_POE_LATENCY", "0.01")
+os.environ.setdefault("FAKE_POE_CHUNK_DELAY", "0.01")
+os.environ.setdefault("FAKE_POE_CHUNKS", "5")
+os.environ.setdefault("POE_WORKER_COORDINATION", "none")
+os.environ.setdefault("POE_LOG_FILE", os.path.join(tempfile.gettempdir(), "poe-server-tests.log"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402  (needs the environment above)
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """Start the app in ``tmp_path`` with ``tokens`` fake tokens.
+
+    Returns an async context manager that yields an httpx client talking to
+    the app in-process. Use it inside ``asyncio.run``.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "drain", server.DrainState())
+    monkeypatch.setattr(server, "batches", server.BatchRegistry())
+
+    @contextlib.asynccontextmanager
+    async def running(tokens: int = 4):
+        (tmp_path / "tokens.txt").write_text("".join(f"token{i}\n" for i in range(tokens)))
+        # Tokens are paired with proxies line by line, so one proxy each.
+        (tmp_path / "proxies.txt").write_text("".join(f"http://127.0.0.1:{3128 + i}\n" for i in range(tokens)))
+        await server.startup_event()
+        try:
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+                yield client
+        finally:
+            await server.shutdown_event()
+            server._log_listener.start()  # shutdown stops it; the next test needs it again
+
+    return running
@@ -0,0 +1,112 @@
+import asyncio
+import types
+
+import pytest
+
+import server
+
+
+class FakePool:
+    """Stands in for ClientPool: ``size`` clients, all able to serve every model."""
+
+    def __init__(self, size: int):
+        self.slots = [types.SimpleNamespace(latency=None) for _ in range(size)]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def eligible(self, codename):
+        return self.slots
+
+    def mean_latency(self):
+        return server.ClientSlot.DEFAULT_LATENCY
+
+
+def controller(size=1, queue_per_client=2, max_wait=0.05):
+    return server.AdmissionController(FakePool(size), per_client=1, queue_per_client=queue_per_client, max_wait=max_wait)
+
+
+def test_admits_up_to_capacity_then_queues():
+    async def main():
+        admission = controller(size=2)
+        order = []
+
+        async def request(name, hold):
+            async with admission.admit("capybara"):
+                order.append(name)
+                await asyncio.sleep(hold)
+
+        await asyncio.gather(request("a", 0.02), request("b", 0.02), request("c", 0))
+        assert order == ["a", "b", "c"]
+        assert admission.running == 0
+        assert admission.stats()["queue_depth"] == 0
+
+    asyncio.run(main())
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def main():
+        admission = controller(size=1, queue_per_client=1, max_wait=1)
+        held = asyncio.Event()
+        done = asyncio.Event()
+
+        async def holder():
+            async with admission.admit("capybara"):
+                held.set()
+                await done.wait()
+
+        task = asyncio.create_task(holder())
+        await held.wait()
+        waiter = asyncio.create_task(admission.admit("capybara").__aenter__())
+        await asyncio.sleep(0)
+        with pytest.raises(server.Overloaded) as info:
+            async with admission.admit("capybara"):
+                pass
+        assert info.value.retry_after >= 1
+        done.set()
+        await task
+        await waiter  # admitted once the holder left
+        assert admission.running == 1
+        admission._release()
+        assert admission.rejected == 1
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_is_rejected():
+    async def main():
+        admission = controller(max_wait=0.02)
+        async with admission.admit("capybara"):
+            with pytest.raises(server.Overloaded):
+                async with admission.admit("capybara"):
+                    pass
+        assert admission.running == 0
+        assert admission.timed_out == 1
+
+    asyncio.run(main())
+
+
+def test_slot_handed_over_as_the_wait_times_out(monkeypatch):
+    """_wake() can hand a waiter its slot between the timeout and wait_for returning."""
+
+    async def main():
+        admission = controller()
+        real_wait_for = asyncio.wait_for
+
+        async def wait_for_that_times_out_late(awaitable, timeout):
+            admission._release()  # a running request finishes in the window
+            awaitable.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await awaitable
+            raise asyncio.TimeoutError
+
+        admission.running = 1
+        monkeypatch.setattr(server.asyncio, "wait_for", wait_for_that_times_out_late)
+        async with admission.admit("capybara"):
+            assert admission.running == 1
+        monkeypatch.setattr(server.asyncio, "wait_for", real_wait_for)
+        assert admission.running == 0
+        assert admission.timed_out == 0
+
+    asyncio.run(main())
+
@@ -0,0 +1,108 @@
+"""End-to-end requests against the app on the fake backend."""
+import asyncio
+import json
+
+import server
+
+CHAT = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_chat_completion(app):
+    async def main():
+        async with app() as client:
+            response = await client.post("/v1/chat/completions", json=CHAT)
+            assert response.status_code == 200
+            assert response.json()["choices"][0]["message"]["content"].startswith("beaver reply to: hi")
+            assert "x-request-id" in response.headers
+
+    asyncio.run(main())
+
+
+def test_streamed_chat_completion(app):
+    async def main():
+        async with app() as client:
+            response = await client.post("/v1/chat/completions", json={**CHAT, "stream": True})
+            assert response.status_code == 200
+            lines = [line for line in response.text.splitlines() if line.startswith("data: ")]
+            assert lines[-1] == "data: [DONE]"
+            chunks = [json.loads(line[6:]) for line in lines[:-1]]
+            text = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+            assert text.startswith("beaver reply to: hi")
+            assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+    asyncio.run(main())
+
+
+def test_full_queue_answers_429(app, monkeypatch):
+    monkeypatch.setattr(server.poe, "CHUNKS", 20)
+    monkeypatch.setattr(server.poe, "CHUNK_DELAY", 0.02)
+
+    async def main():
+        async with app(tokens=1) as client:
+            server.poe_provider.admission.queue_per_client = 1
+            running = asyncio.create_task(client.post("/v1/chat/completions", json=CHAT))
+            await asyncio.sleep(0.05)
+            queued = asyncio.create_task(client.post("/v1/chat/completions", json=CHAT))
+            await asyncio.sleep(0.05)
+            response = await client.post("/v1/chat/completions", json=CHAT)
+            assert response.status_code == 429
+            assert int(response.headers["Retry-After"]) >= 1
+            assert (await running).status_code == 200
+            assert (await queued).status_code == 200
+            assert server.poe_provider.admission.running == 0
+
+    asyncio.run(main())
+
+
+def test_one_line_jsonl_batch(app):
+    async def main():
+        async with app() as client:
+            body = json.dumps({"custom_id": "only", "body": CHAT}) + "\n"
+            response = await client.post("/v1/batch/chat/completions", content=body)
+            assert response.status_code == 200
+            header, *results = [json.loads(line) for line in response.text.splitlines()]
+            assert header["id"] == response.headers["X-Batch-Id"]
+            assert [result["custom_id"] for result in results] == ["only"]
+            assert results[0]["error"] is None
+
+    asyncio.run(main())
+
+
+def test_quarantine_is_kept_across_restarts(app):
+    async def main():
+        async with app() as client:
+            server.poe_provider.quarantine.add(server.token_id("token1"), "auth")
+            await asyncio.sleep(0.2)  # saved in the background
+        async with app() as client:
+            status = (await client.get("/v1/status")).json()
+            assert status["quarantine"]["reasons"] == {"auth": 1}
+            await asyncio.sleep(0.1)  # the clients past the first connect in the background
+            connected = {slot.id for slot in server.poe_provider.pool.slots}
+            assert connected == {server.token_id(f"token{i}") for i in (0, 2, 3)}
+
+    asyncio.run(main())
+
+
+def test_every_token_gets_a_client(app):
+    async def main():
+        async with app(tokens=4):
+            await asyncio.sleep(0.1)
+            assert len(server.poe_provider.pool) == 4
+
+    asyncio.run(main())
+
+
+def test_draining_refuses_new_work(app):
+    async def main():
+        async with app() as client:
+            assert (await client.get("/ready")).status_code == 200
+            server.drain.begin()
+            response = await client.post("/v1/chat/completions", json=CHAT)
+            assert response.status_code == 503
+            assert response.headers["Retry-After"]
+            assert (await client.get("/ready")).status_code == 503
+            assert (await client.get("/v1/status")).status_code == 200
+            assert server.drain.resume()
+            assert (await client.post("/v1/chat/completions", json=CHAT)).status_code == 200
+
+    asyncio.run(main())
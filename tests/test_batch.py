@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import pytest
+
+import server
+
+CHAT = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_json_list():
+    assert server._parse_batch_body(json.dumps([CHAT, CHAT]).encode()) == ([CHAT, CHAT], None)
+
+
+def test_requests_object_with_concurrency():
+    body = {"requests": [CHAT], "concurrency": 3}
+    assert server._parse_batch_body(json.dumps(body).encode()) == ([CHAT], 3)
+
+
+def test_jsonl():
+    body = "\n".join(json.dumps({"custom_id": str(i), "body": CHAT}) for i in range(3)) + "\n\n"
+    items, concurrency = server._parse_batch_body(body.encode())
+    assert [item["custom_id"] for item in items] == ["0", "1", "2"]
+    assert concurrency is None
+
+
+def test_one_line_jsonl_is_one_request():
+    line = json.dumps({"custom_id": "only", "body": CHAT}) + "\n"
+    assert server._parse_batch_body(line.encode()) == ([{"custom_id": "only", "body": CHAT}], None)
+    assert server._parse_batch_body(json.dumps(CHAT).encode()) == ([CHAT], None)
+
+
+def test_not_a_list_is_rejected():
+    with pytest.raises(ValueError):
+        server._parse_batch_body(b'"hello"')
+
+
+class BusyProvider:
+    """Turns every request away as overloaded, ``busy`` times (forever if None)."""
+
+    def __init__(self, busy=None):
+        self.busy = busy
+        self.calls = 0
+
+    async def complete(self, messages, model, use_cache=True):
+        self.calls += 1
+        if self.busy is None or self.calls <= self.busy:
+            raise server.Overloaded("Server is busy, request queue is full.", 0)
+        return "done"
+
+
+def run_batch(provider, items):
+    async def main():
+        job = server.BatchJob(items, concurrency=2)
+        await job.run(provider)
+        return job
+
+    return asyncio.run(main())
+
+
+def test_item_waits_for_room():
+    job = run_batch(BusyProvider(busy=3), [CHAT])
+    assert job.status == "completed"
+    assert job.results[0]["error"] is None
+    assert job.results[0]["response"]["choices"][0]["message"]["content"] == "done"
+
+
+def test_item_that_never_gets_room_fails(monkeypatch):
+    monkeypatch.setattr(server, "BATCH_ITEM_MAX_WAIT", 0.05)
+    job = run_batch(BusyProvider(), [CHAT, CHAT])
+    assert job.status == "completed"
+    assert job.failed == 2
+    assert all(result["error"]["type"] == "Overloaded" for result in job.results)
@@ -0,0 +1,24 @@
+import pytest
+
+import server
+from server import Message
+
+
+def test_trim_keeps_the_order_of_the_remaining_messages():
+    long = "x" * 7000  # about 2000 tokens
+    messages = [
+        Message(role="system", content="Be brief."),
+        Message(role="user", content=long),
+        Message(role="assistant", content=long),
+        Message(role="system", content="Now answer in French."),
+        Message(role="user", content="Bonjour?"),
+    ]
+    trimmed, codename = server.fit_context(messages, "capybara", overflow="trim")
+    assert codename == "capybara"
+    assert [msg.content for msg in trimmed] == ["Be brief.", long, "Now answer in French.", "Bonjour?"]
+
+
+def test_trim_never_drops_the_last_message():
+    messages = [Message(role="user", content="x" * 20000)]
+    with pytest.raises(server.ContextTooLarge):
+        server.fit_context(messages, "capybara", overflow="trim")
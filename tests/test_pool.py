@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import server
+
+
+def pool(size: int) -> server.ClientPool:
+    return server.ClientPool([server.ClientSlot(f"token{i}", None, None) for i in range(size)], per_client=1)
+
+
+def test_unmeasured_slots_are_not_penalised():
+    clients = pool(3)
+    clients.slots[0].latency = 0.3
+    clients.slots[0].in_flight = 1
+    assert clients.pick("beaver") is not clients.slots[0]
+
+
+def test_saturated_slots_come_last():
+    clients = pool(2)
+    clients.slots[0].latency = 0.1
+    clients.slots[0].in_flight = 1
+    clients.slots[1].latency = 3.0
+    assert clients.pick("beaver") is clients.slots[1]
+
+
+def test_fastest_free_slot_is_picked():
+    clients = pool(3)
+    for slot, latency in zip(clients.slots, (0.5, 0.2, 0.9)):
+        slot.latency = latency
+    assert clients.pick("beaver") is clients.slots[1]
+
+
+def test_concurrent_requests_spread_over_idle_clients(app):
+    async def main():
+        async with app(tokens=4) as client:
+            await asyncio.sleep(0.1)
+            body = {"model": "gpt-4", "messages": [{"role": "user", "content": "warm up"}]}
+            assert (await client.post("/v1/chat/completions", json=body)).status_code == 200
+            responses = await asyncio.gather(
+                *(
+                    client.post("/v1/chat/completions", json={**body, "messages": [{"role": "user", "content": str(i)}]})
+                    for i in range(4)
+                )
+            )
+            assert all(response.status_code == 200 for response in responses)
+            assert all(slot.latency is not None for slot in server.poe_provider.pool.slots)
+
+    asyncio.run(main())
+
+
+def test_new_conversations_spare_chats_holding_one():
+    clients = pool(2)
+    clients.affinity = server.ConversationAffinity()
+    first, second = clients.slots
+    clients.affinity.record(first.id, "beaver", [("user", "hi"), ("assistant", "hello")])
+    assert clients.pick("beaver") is second
+    clients.affinity.record(second.id, "beaver", [("user", "hey"), ("assistant", "hello")])
+    assert clients.pick("beaver") is first  # least recently used
+
+
+def test_interleaved_conversations_keep_their_chats(app):
+    async def main():
+        async with app(tokens=4) as client:
+            await asyncio.sleep(0.1)
+            conversations = [[{"role": "user", "content": f"conversation {i}"}] for i in range(2)]
+            for turn in range(4):
+                for messages in conversations:
+                    response = await client.post("/v1/chat/completions", json={"model": "gpt-4", "messages": messages})
+                    assert response.status_code == 200
+                    messages.append(response.json()["choices"][0]["message"])
+                    messages.append({"role": "user", "content": f"turn {turn}"})
+            affinity = server.poe_provider.affinity
+            assert (affinity.hits, affinity.misses) == (6, 0)
+
+    asyncio.run(main())
+
+
+def test_hedge_loser_stays_busy_until_its_thread_returns(app, monkeypatch):
+    stream_reply = server._stream_reply
+    slow_clients = []
+
+    def slow_first_call(client, *args, **kwargs):
+        if not slow_clients:
+            slow_clients.append(client)
+            time.sleep(0.5)
+        yield from stream_reply(client, *args, **kwargs)
+
+    async def main():
+        async with app(tokens=2) as client:
+            await asyncio.sleep(0.1)
+            provider = server.poe_provider
+            provider.hedging.delays[server.resolve_model("gpt-4")] = 0.05
+            provider.hedging.budget = 0.5
+            provider.hedging.calls = 100
+            monkeypatch.setattr(server, "_stream_reply", slow_first_call)
+            body = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}]}
+            assert (await client.post("/v1/chat/completions", json=body)).status_code == 200
+            assert provider.hedging.hedge_wins == 1
+            loser = next(slot for slot in provider.pool.slots if slot.client is slow_clients[0])
+            winner = next(slot for slot in provider.pool.slots if slot is not loser)
+            assert loser.in_flight == 1
+            assert loser.latency > winner.latency
+            await asyncio.sleep(0.6)
+            assert loser.in_flight == 0
+
+    asyncio.run(main())
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import server
+
+
+def quarantine(rows=()):
+    async def build():
+        q = server.TokenQuarantine()
+        q.load(list(rows))
+        return q
+
+    return asyncio.run(build())
+
+
+def test_saved_quarantine_survives_a_restart(tmp_path):
+    path = str(tmp_path / "tokens.quarantine.json")
+    q = quarantine()
+    q.add("tok1", "quota", "beaver")
+    q.add("tok2", "auth")
+    server.save_quarantine_to_file(path, q.rows(), q.lifted_rows())
+
+    restarted = quarantine(server.load_quarantine_from_file(path))
+    assert not restarted.allows("tok1", "beaver")
+    assert restarted.allows("tok1", "capybara")
+    assert restarted.blocks_connect("tok2")
+
+
+def test_early_release_is_saved(tmp_path):
+    path = str(tmp_path / "tokens.quarantine.json")
+    q = quarantine()
+    q.add("tok1", "quota", "beaver")
+    server.save_quarantine_to_file(path, q.rows(), q.lifted_rows())
+    q.release("tok1", "beaver")
+    server.save_quarantine_to_file(path, q.rows(), q.lifted_rows())
+
+    assert server.load_quarantine_from_file(path) == []
+    assert quarantine(server.load_quarantine_from_file(path)).allows("tok1", "beaver")
+
+
+def test_rows_of_other_workers_are_kept(tmp_path):
+    path = str(tmp_path / "tokens.quarantine.json")
+    other = quarantine()
+    other.add("tok1", "quota", "beaver", until=time.time() + 500)
+    other.add("tok3", "timeout")
+    server.save_quarantine_to_file(path, other.rows(), other.lifted_rows())
+
+    mine = quarantine()
+    mine.add("tok1", "quota", "beaver", until=time.time() + 100)
+    mine.release("tok1", "beaver")
+    mine.add("tok2", "auth")
+    server.save_quarantine_to_file(path, mine.rows(), mine.lifted_rows())
+
+    restarted = quarantine(server.load_quarantine_from_file(path))
+    assert not restarted.allows("tok1", "beaver")  # the other worker's quarantine still holds
+    assert not restarted.allows("tok2")
+    assert not restarted.allows("tok3")
+
+
+def test_expired_rows_are_not_saved(tmp_path):
+    path = str(tmp_path / "tokens.quarantine.json")
+    q = quarantine()
+    q.add("tok1", "timeout", until=time.time() - 1)
+    server.save_quarantine_to_file(path, q.rows(), q.lifted_rows())
+    assert server.load_quarantine_from_file(path) == []
+
+
+def _save_rows(path, worker):
+    until = time.time() + 3600
+    for i in range(50):
+        row = {"token": f"tok{worker}-{i}", "codename": None, "reason": "quota", "until": until}
+        server.save_quarantine_to_file(path, [row])
+
+
+def test_concurrent_workers_keep_every_row(tmp_path):
+    import multiprocessing
+
+    path = str(tmp_path / "tokens.quarantine.json")
+    workers = [multiprocessing.Process(target=_save_rows, args=(path, worker)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+    assert all(process.exitcode == 0 for process in workers)
+    assert len(server.load_quarantine_from_file(path)) == 200
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["tokens.quarantine.json", "tokens.quarantine.json.lock"]
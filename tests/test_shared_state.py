@@ -0,0 +1,58 @@
+import itertools
+
+import server
+
+TOKENS = [f"token{i}" for i in range(5)]
+
+
+def held(state, pids):
+    return {pid: state.sync(pid, TOKENS) for pid in pids}
+
+
+def assert_balanced(leases, tokens=TOKENS):
+    counts = sorted(len(mine) for mine in leases.values())
+    assert counts[-1] - counts[0] <= 1
+    assert sum(counts) == len(tokens)
+    assert set().union(*leases.values()) == set(tokens)
+
+
+def test_uneven_tokens_leave_no_worker_empty(tmp_path):
+    state = server.SharedState(str(tmp_path / "state.db"))
+    pids = [101, 102, 103, 104]
+    for pid in pids:
+        state.register(pid)
+    for _ in range(3):
+        leases = held(state, pids)
+        assert_balanced(leases)
+    assert [len(leases[pid]) for pid in pids] == [2, 1, 1, 1]
+
+
+def test_every_sync_order_converges(tmp_path):
+    for order in itertools.permutations([101, 102, 103, 104]):
+        state = server.SharedState(str(tmp_path / f"state-{'-'.join(map(str, order))}.db"))
+        for pid in order:
+            state.register(pid)
+        held(state, order)
+        assert_balanced(held(state, order))
+
+
+def test_late_workers_take_leases_from_the_first(tmp_path):
+    state = server.SharedState(str(tmp_path / "state.db"))
+    assert state.sync(101, TOKENS) == set(TOKENS)
+    for pid in (102, 103, 104):
+        state.register(pid)
+    leases = held(state, [102, 103, 104, 101])
+    assert_balanced(leases)
+    assert all(leases.values())
+
+
+def test_fewer_tokens_than_workers(tmp_path):
+    state = server.SharedState(str(tmp_path / "state.db"))
+    pids = [101, 102, 103, 104]
+    for pid in pids:
+        state.register(pid)
+    tokens = TOKENS[:3]
+    for _ in range(2):
+        leases = {pid: state.sync(pid, tokens) for pid in reversed(pids)}
+    assert [len(leases[pid]) for pid in pids] == [1, 1, 1, 0]
+    assert_balanced(leases, tokens)
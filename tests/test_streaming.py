@@ -0,0 +1,227 @@
+import asyncio
+import json
+
+import pytest
+
+import server
+
+
+def request_scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("test", 80),
+    }
+
+
+async def disconnect_after(path: str, body: dict, events: int) -> list:
+    """Call the app directly and drop the connection after ``events`` SSE events."""
+    sent = []
+    enough = asyncio.Event()
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}
+        await enough.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if sum(m.get("body", b"").count(b"data: ") for m in sent) >= events:
+            enough.set()
+
+    await server.app(request_scope(path), receive, send)
+    return sent
+
+
+def outcomes(codename: str) -> dict:
+    return {labels[1]: value for labels, value in server.metrics.requests._values.items() if labels[0] == codename}
+
+
+def test_disconnect_mid_stream_is_cleaned_up(app, monkeypatch):
+    monkeypatch.setattr(server.poe, "CHUNKS", 50)
+    monkeypatch.setattr(server.poe, "CHUNK_DELAY", 0.02)
+
+    async def main():
+        async with app():
+            before = outcomes("beaver").get("disconnected", 0)
+            body = {"model": "gpt-4", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+            sent = await disconnect_after("/v1/chat/completions", body, events=2)
+            assert sent[0]["status"] == 200
+            assert outcomes("beaver").get("disconnected", 0) == before + 1
+            await asyncio.sleep(0.1)
+            assert server.poe_provider.executor.active == 0
+            assert all(slot.in_flight == 0 for slot in server.poe_provider.pool.slots)
+
+    asyncio.run(main())
+
+
+async def slow_reply(pieces: int):
+    for i in range(pieces):
+        await asyncio.sleep(0.01)
+        yield f"{i} "
+
+
+def test_completion_fanout_closes_running_streams():
+    async def main():
+        merged = server.CompletionFanout([slow_reply(100), slow_reply(100)])
+        [(index, text, error)] = await merged.first(1)
+        assert text == "0 " and error is None
+        await merged.close()
+        for task in merged.tasks:
+            assert task.cancelled() or task.exception() is None
+
+    asyncio.run(main())
+
+
+def test_completion_fanout_merges_every_choice():
+    async def main():
+        merged = server.CompletionFanout([slow_reply(3), slow_reply(5)])
+        texts = {0: "", 1: ""}
+        ended = []
+        async for index, text, error in merged.items():
+            assert error is None
+            if text is None:
+                ended.append(index)
+            else:
+                texts[index] += text
+        await merged.close()
+        assert texts == {0: "0 1 2 ", 1: "0 1 2 3 4 "}
+        assert sorted(ended) == [0, 1]
+
+    asyncio.run(main())
+
+
+async def failing_reply():
+    await asyncio.sleep(0.01)
+    raise RuntimeError("Failed after retries.")
+    yield
+
+
+def test_completion_fanout_raises_when_every_choice_fails():
+    async def main():
+        merged = server.CompletionFanout([failing_reply(), failing_reply()])
+        with pytest.raises(RuntimeError):
+            await merged.first(1)
+
+    asyncio.run(main())
+
+
+def test_completion_fanout_replays_errors_seen_before_the_first_text():
+    async def main():
+        merged = server.CompletionFanout([failing_reply(), slow_reply(3)])
+        early = await merged.first(1)
+        assert [(index, text) for index, text, _ in early] == [(0, None), (1, "0 ")]
+        items = [item async for item in merged.items(early)]
+        await merged.close()
+        assert isinstance(items[0][2], RuntimeError)
+        assert "".join(text for index, text, _ in items if index == 1 and text) == "0 1 2 "
+
+    asyncio.run(main())
+
+
+def test_completions_stream_fails_with_500_when_every_choice_fails(app, monkeypatch):
+    async def main():
+        async with app() as client:
+            monkeypatch.setattr(server.poe_provider, "instruct_stream", lambda **kwargs: failing_reply())
+            response = await client.post(
+                "/v1/engines/gpt-4/completions", json={"prompt": "hi", "n": 2, "stream": True}
+            )
+            assert response.status_code == 500
+
+    asyncio.run(main())
+
+
+def test_stream_rejected_by_the_queue_gets_429(app, monkeypatch):
+    monkeypatch.setattr(server, "SSE_FIRST_PIECE_WAIT", 0.05)
+    monkeypatch.setattr(server.poe, "CHUNKS", 40)
+    monkeypatch.setattr(server.poe, "CHUNK_DELAY", 0.02)
+
+    async def main():
+        async with app(tokens=1) as client:
+            server.poe_provider.admission.max_wait = 0.3
+            body = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}]}
+            busy = asyncio.create_task(client.post("/v1/chat/completions", json=body))
+            await asyncio.sleep(0.05)
+            response = await client.post("/v1/chat/completions", json={**body, "stream": True})
+            assert response.status_code == 429
+            assert "Retry-After" in response.headers
+            assert (await busy).status_code == 200
+
+    asyncio.run(main())
+
+
+def test_stream_waits_for_the_queue_then_streams(app, monkeypatch):
+    monkeypatch.setattr(server, "SSE_FIRST_PIECE_WAIT", 0.05)
+    monkeypatch.setattr(server.poe, "CHUNKS", 10)
+    monkeypatch.setattr(server.poe, "CHUNK_DELAY", 0.02)
+
+    async def main():
+        async with app(tokens=1) as client:
+            body = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}]}
+            busy = asyncio.create_task(client.post("/v1/chat/completions", json=body))
+            await asyncio.sleep(0.05)
+            response = await client.post("/v1/chat/completions", json={**body, "stream": True})
+            assert response.status_code == 200
+            assert response.text.rstrip().endswith("data: [DONE]")
+            assert '"error"' not in response.text
+            assert (await busy).status_code == 200
+
+    asyncio.run(main())
+
+
+def test_completion_stream_rejected_by_the_queue_gets_429(app, monkeypatch):
+    monkeypatch.setattr(server, "SSE_FIRST_PIECE_WAIT", 0.05)
+    monkeypatch.setattr(server.poe, "CHUNKS", 40)
+    monkeypatch.setattr(server.poe, "CHUNK_DELAY", 0.02)
+
+    async def main():
+        async with app(tokens=1) as client:
+            server.poe_provider.admission.max_wait = 0.3
+            busy = asyncio.create_task(client.post("/v1/engines/gpt-4/completions", json={"prompt": "hi"}))
+            await asyncio.sleep(0.05)
+            response = await client.post("/v1/engines/gpt-4/completions", json={"prompt": "hi", "stream": True})
+            assert response.status_code == 429
+            assert (await busy).status_code == 200
+
+    asyncio.run(main())
+
+
+async def reply_then_fail():
+    yield "partial "
+    raise RuntimeError("Response timed out.")
+
+
+def test_stream_cut_short_does_not_end_with_stop():
+    async def main():
+        encoder = server.SSEEncoder("chatcmpl-test", "gpt-4")
+        events = [event async for event in server.stream_response(encoder, reply_then_fail())]
+        body = "".join(events)
+        chunks = [json.loads(line[6:]) for line in body.splitlines() if line.startswith("data: {")]
+        assert chunks[-1]["error"]["message"] == "Response timed out."
+        assert all(chunk["choices"][0]["finish_reason"] is None for chunk in chunks[:-1])
+        assert body.endswith("data: [DONE]\n\n")
+
+    asyncio.run(main())
+
+
+def test_complete_stream_ends_with_stop():
+    async def main():
+        encoder = server.SSEEncoder("chatcmpl-test", "gpt-4")
+        events = [event async for event in server.stream_response(encoder, slow_reply(3))]
+        assert "stop" in events[-1]
+        assert events[-1].endswith("data: [DONE]\n\n")
+
+    asyncio.run(main())